@@ -22,83 +22,212 @@ from __future__ import absolute_import
 
 import os
 import sys
+import errno
+import random
+import filecmp
+import time
+import ctypes
 import signal
+import pstats
+import cProfile
 import traceback
+from functools import partial
 from os.path import join, dirname, exists, isfile, isdir, realpath
 from argparse import ArgumentParser, ArgumentTypeError
-from multiprocessing import Process, cpu_count, Value, Manager, Lock
+from multiprocessing import Process, Queue, cpu_count, Value
+from multiprocessing.sharedctypes import RawArray
+try:
+    from Queue import Full, Empty
+except ImportError:
+    from queue import Full, Empty
 
 import chatlogsync
-from chatlogsync import const, formats, util, timezones
+from chatlogsync import const, formats, util, timezones, imagestore, timing
+from chatlogsync.syncstate import SyncState
+from chatlogsync.errors import VerificationError, WorkerError
 
 WORKERS = []
+# upper bounds for the number of files and bytes handed to a worker at once
+CHUNK_FILES = 256
+CHUNK_BYTES = 4 << 20
+# files written to the --profile directory, and functions summarized
+PROFILE_COMBINED = 'combined.pstats'
+PROFILE_SUMMARY = 'summary.txt'
+PROFILE_TOP = 30
 
 class Progress(object):
-    """Thread-safe progress updater"""
-    def __init__(self):
-        self._nread = Value('i', 0, lock=False)
-        self._nwrote = Value('i', 0, lock=False)
-        self._nexisting = Value('i', 0, lock=False)
-        self._nerror = Value('i', 0, lock=False)
-        self._lock = Lock()
-
-    def print_status(self, msg=None):
-        dryrun = ' (DRY RUN)' if const.DRYRUN else ''
-        if msg:
-            print_v(msg)
-        print_('\r[read:%i wrote:%i existing:%i error:%i]%s ' %
-               (self.nread, self.nwrote, self.nexisting, self.nerror, dryrun),
-               end='', flush=True, file=sys.stderr)
-        if msg:
-            print_v('\n')
-
-    def _incr(self, var, n=1):
-        with self._lock:
-            var.value += n
-
-    def read(self, path):
-        self._incr(self._nread)
+    """Progress counters shared between processes
+
+    Each worker only updates its own row of counters, so no lock is
+    needed.  The status line is drawn by the parent process alone, at
+    most once every REDRAW_INTERVAL seconds.
+    """
+    COUNTERS = ('done', 'read', 'wrote', 'existing', 'unchanged', 'skipped',
+                'error', 'bytes_read', 'bytes_written', 'image_hits',
+                'image_misses')
+    REDRAW_INTERVAL = 0.25
+
+    def __init__(self, nworkers):
+        self._ncounters = len(self.COUNTERS)
+        self._counts = RawArray(ctypes.c_longlong,
+                                nworkers * self._ncounters)
+        self._row = 0
+        self._start = time.time()
+        self._last_draw = 0
+        # number of source files found so far, and whether that is all
+        self.ndiscovered = 0
+        self.discovering = True
+
+    def set_worker(self, index):
+        """Make this process update the counters of worker index"""
+        self._row = index * self._ncounters
+
+    def _incr(self, counter, n=1):
+        self._counts[self._row + self.COUNTERS.index(counter)] += n
+
+    def _total(self, counter):
+        i = self.COUNTERS.index(counter)
+        return sum(self._counts[i:len(self._counts):self._ncounters])
+
+    def print_status(self, force=False):
+        now = time.time()
+        if not force and (const.VERBOSE or
+                          now - self._last_draw < self.REDRAW_INTERVAL):
+            # in verbose mode, only the final status is drawn
+            return
+        self._last_draw = now
 
-    def wrote(self, path):
-        self._incr(self._nwrote)
-        self.print_status('wrote %s' % path)
+        dryrun = ' (DRY RUN)' if const.DRYRUN else ''
+        elapsed = max(now - self._start, 1e-6)
+        ndone = self.ndone
+        rate = ndone / elapsed
+        mbrate = (self.nbytes_read / elapsed) / (1 << 20)
+        if rate:
+            eta = int(max(self.ndiscovered - ndone, 0) / rate)
+            eta = '%i:%02i:%02i%s' % (eta // 3600, eta // 60 % 60, eta % 60,
+                                      '+' if self.discovering else '')
+        else:
+            eta = '-:--:--'
+        print_('\r[read:%i wrote:%i existing:%i unchanged:%i skipped:%i '
+               'error:%i] %.1f files/s %.1f MB/s ETA %s%s ' %
+               (self.nread, self.nwrote, self.nexisting, self.nunchanged,
+                self.nskipped, self.nerror, rate, mbrate, eta, dryrun),
+               end='\n' if const.VERBOSE else '', flush=True,
+               file=sys.stderr)
+
+    def done(self, path):
+        self._incr('done')
+
+    def read(self, path, size=0):
+        self._incr('read')
+        self._incr('bytes_read', size)
+
+    def wrote(self, path, size=0):
+        self._incr('wrote')
+        self._incr('bytes_written', size)
+        print_v('wrote %s' % path)
 
     def error(self, path):
         tb = traceback.format_exc()
-        self._incr(self._nerror)
+        self._incr('error')
         print_e('%s\n%s' % (path, tb))
 
     def existing(self, path):
-        self._incr(self._nexisting)
+        self._incr('existing')
         print_v('existing %s' % path)
 
+    def unchanged(self, path):
+        self._incr('unchanged')
+        print_v('unchanged %s' % path)
+
+    def skipped(self, path):
+        self._incr('skipped')
+        print_d('skipped %s' % path)
+
+    def image_sizes(self, hits, misses):
+        self._incr('image_hits', hits)
+        self._incr('image_misses', misses)
+
+    def print_summary(self):
+        nimages = self.nimage_hits + self.nimage_misses
+        if nimages:
+            print_('image sizes: %i cached, %i read' %
+                   (self.nimage_hits, self.nimage_misses), file=sys.stderr)
+        print_v('%.1fs, %.1f MB read, %.1f MB written' %
+                (self.elapsed, self.nbytes_read / float(1 << 20),
+                 self.nbytes_written / float(1 << 20)))
+
     @property
-    def nerror(self):
-        return self._nerror.value
-    @property
-    def nwrote(self):
-        return self._nwrote.value
+    def elapsed(self):
+        return time.time() - self._start
     @property
     def nread(self):
-        return self._nread.value
+        return self._total('read')
+    @property
+    def nwrote(self):
+        return self._total('wrote')
     @property
     def nexisting(self):
-        return self._nexisting.value
+        return self._total('existing')
+    @property
+    def nunchanged(self):
+        return self._total('unchanged')
+    @property
+    def nskipped(self):
+        return self._total('skipped')
+    @property
+    def nerror(self):
+        return self._total('error')
+    @property
+    def ndone(self):
+        return self._total('done')
+    @property
+    def nbytes_read(self):
+        return self._total('bytes_read')
+    @property
+    def nbytes_written(self):
+        return self._total('bytes_written')
+    @property
+    def nimage_hits(self):
+        return self._total('image_hits')
+    @property
+    def nimage_misses(self):
+        return self._total('image_misses')
 
 class Parser(Process):
-    def __init__(self, outformat, force, destination, queue, files,
-                 progress, fslock):
+    def __init__(self, outformat, force, destination, queue, progress,
+                 state=None, passthrough=None, verify=0.0, image_store=None,
+                 durability='none', index=0, results=None, profile=None):
         super(Parser, self).__init__()
         self.queue = queue
         self.progress = progress
         self.tempfiles = []
+        self._ntmp = 0
         self.destination = destination
         self.outformat = outformat
         self.force = force
-        self._files = files
-        self._fslock = fslock
-        self._modules = [x() for x in formats.all_formats.values()]
-        self._modules_map = {x.type: x for x in self._modules}
+        self._state = state
+        self.passthrough = passthrough
+        self.verify = verify
+        self._modules_map = {k: v() for k, v in
+                             iter(formats.all_formats.items())}
+        self.image_store = image_store
+        self.durability = durability
+        self.index = index
+        # where timings are sent at shutdown, if a report is wanted
+        self.results = results
+        self.timings = timing.Timings() if results else None
+        # directory to dump profiling data to, if any
+        self.profile = profile
+        # parents of directories created since they were last synced
+        self._newdirs = set()
+        # (tmppath, path, dstpath, after, source) and (source, state
+        # record) waiting for the current batch to be synced
+        self._batch = []
+        self._batch_records = []
+        for module in self._modules_map.values():
+            module.image_store = image_store
+            module.timings = self.timings
         self._stopped = Value('i', 0)
         self._curpath = ''
 
@@ -113,80 +242,299 @@ class Parser(Process):
         for tempfile in self.tempfiles:
             if exists(tempfile):
                 os.unlink(tempfile)
+        if self._state:
+            self._state.close()
+
+    def _time(self, fmt, stage, start, exclude=0.0):
+        """Record time since start, less exclude, for stage and return
+        the current time"""
+        now = time.time()
+        if self.timings:
+            self.timings.add(fmt, stage, now - start - exclude)
+        return now
+
+    def _images_time(self, module):
+        """Return time module has spent copying images so far"""
+        if self.timings:
+            return self.timings.total(module.type, 'copy_images')
+        return 0.0
 
     def _process_path(self, path):
         self._curpath = path
+        start = time.time()
+        self._process_path_timed(path, start)
+        if self.timings:
+            self.timings.add_file(path, time.time() - start)
+
+    def _process_path_timed(self, path, t):
+        rmodules = [self._modules_map[x] for x in formats.claimants(path)]
+        rmodules = [x for x in rmodules if x.claims(path)]
+        if not rmodules:
+            self.progress.skipped(path)
+            return None
 
-        for i, rmodule in enumerate(self._modules):
+        st = os.stat(path)
+        if self._state:
+            statepath = realpath(path)
+            stateformat = self.outformat or ''
+            unchanged = not self.force and \
+                self._state.unchanged(statepath, st, stateformat)
+            t = self._time(rmodules[0].type, 'state', t)
+            if unchanged:
+                self.progress.unchanged(path)
+                return None
+
+        for rmodule in rmodules:
             parsed = rmodule.parse_path(path)
             if parsed:
-                # try this module first next time
-                if i != 0:
-                    self._modules[i] = self._modules[0]
-                    self._modules[0] = rmodule
                 break
+        t = self._time(rmodule.type, 'parse_path', t)
         # file is not a chatlog
         if not parsed:
+            self.progress.skipped(path)
             return None
-        self.progress.read(path)
+        self.progress.read(path, st.st_size)
 
         wmodule = self._modules_map[self.outformat] \
             if self.outformat else rmodule
+        dstpaths = []
         for c in parsed:
             self._curpath = path
             dstpath = wmodule.get_path(c)
             real_dstpath = realpath(join(self.destination, dstpath))
-            with self._fslock:
-                if real_dstpath in self._files:
-                    f = 1
-                elif exists(real_dstpath):
-                    f = 2
-                else:
-                    f = 0
-                self._files[real_dstpath] = f
-                if f:
-                    self.progress.existing(dstpath)
-                    self.progress.print_status()
-                    if not self.force:
-                        continue
+            dstpaths.append(dstpath)
+            dstexists = exists(real_dstpath)
+            t = self._time(wmodule.type, 'check', t)
+            if dstexists:
+                self.progress.existing(dstpath)
+                if not self.force:
+                    continue
             if const.DRYRUN:
-                conversation = c
+                self.progress.wrote(dstpath)
+                continue
+
+            # unique to this worker and file, since other sources may
+            # be written to the same destination at the same time
+            self._ntmp += 1
+            tmppath = '%s.%i-%i.tmp' % (real_dstpath, os.getpid(),
+                                        self._ntmp)
+            self.tempfiles.append(tmppath)
+            self._curpath = real_dstpath
+            self._makedirs(dirname(real_dstpath))
+            if self.passthrough and wmodule is rmodule:
+                util.copy_file(c.path, tmppath,
+                               link=self.passthrough == 'link')
+                t = self._time(wmodule.type, 'write', t)
+                after = partial(self._copy_images, wmodule, c, real_dstpath)
             else:
                 conversation = rmodule.parse_conversation(c)
-                tmppath = real_dstpath+'.tmp'
-                self.tempfiles.append(tmppath)
-                self._curpath = real_dstpath
-                self._write_outfile(wmodule, real_dstpath, tmppath,
-                                    [conversation])
-                del self.tempfiles[-1]
-            self.progress.wrote(dstpath)
-
-    def _write_outfile(self, module, path, tmppath, conversations):
-        # return len(conversations)
-        dstdir = dirname(path)
-        with self._fslock:
-            if not exists(dstdir):
-                os.makedirs(dstdir)
-
-        module.write(tmppath, conversations)
-        os.rename(tmppath, path)
-
-        return len(conversations)
+                t = self._time(rmodule.type, 'parse_conversation', t)
+                images = self._images_time(wmodule)
+                wmodule.write(tmppath, [conversation])
+                # images are timed separately by wmodule
+                t = self._time(wmodule.type, 'write', t,
+                               self._images_time(wmodule) - images)
+                after = None
+            self._commit(tmppath, real_dstpath, dstpath, after, path)
+            t = time.time()
+
+        if self._state and not const.DRYRUN:
+            args = (statepath, st, stateformat, dstpaths)
+            if self._batch:
+                self._batch_records.append((path, args))
+            else:
+                self._state.record(*args)
+                self._time(rmodule.type, 'state', t)
+
+    def _copy_images(self, module, conversation, path):
+        """Copy images of conversation, whose log was copied to path"""
+        link = self.passthrough == 'link'
+        start = time.time()
+        dstdir = join(dirname(path), module.IMAGE_DIRECTORY)
+        for img_relpath, srcpath in module.get_images(conversation):
+            dstpath = join(dstdir, img_relpath)
+            if module.image_store:
+                # the store skips images that already have the same content
+                self._makedirs(dirname(dstpath))
+                module.image_store.place(srcpath, dstpath)
+            elif not exists(dstpath):
+                self._makedirs(dirname(dstpath))
+                util.copy_file(srcpath, dstpath, link=link)
+        self._time(module.type, 'copy_images', start)
+
+        if self.verify and random.random() < self.verify:
+            self._verify_outfile(module, conversation, path)
+
+    def _verify_outfile(self, module, conversation, path):
+        util.dircache.invalidate(dirname(path))
+        if not filecmp.cmp(conversation.path, path, shallow=False):
+            raise VerificationError("'%s' differs from '%s'" %
+                                    (path, conversation.path))
+
+        keys = ('source', 'destination', 'service', 'time', 'isgroup')
+        parsed = module.parse_path(path)
+        if not parsed or [getattr(conversation, k) for k in keys] != \
+                [getattr(parsed[0], k) for k in keys]:
+            raise VerificationError("'%s' does not parse like '%s'" %
+                                    (path, conversation.path))
+        print_v('verified %s' % path)
+
+    def _makedirs(self, path):
+        if self.durability != 'none':
+            newdir = path
+            while newdir and not isdir(newdir):
+                self._newdirs.add(dirname(newdir))
+                newdir = dirname(newdir)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _commit(self, tmppath, path, dstpath, after=None, source=None):
+        """Publish tmppath, written from source, at path and report it
+        as dstpath, calling after once it is published. Depending on
+        durability, tmppath and path are synced to disk first, or this
+        happens with the rest of the batch in _flush."""
+        if self.durability == 'batch':
+            self._batch.append((tmppath, path, dstpath, after, source))
+            return
+
+        if self.durability == 'strict':
+            util.fsync(tmppath)
+        size = os.path.getsize(tmppath)
+        published = self._publish(tmppath, path)
+        self.tempfiles.remove(tmppath)
+        if not published:
+            # another worker got there first
+            self.progress.existing(dstpath)
+            return
+
+        if self.durability == 'strict':
+            for dirpath in self._newdirs | set((dirname(path),)):
+                util.fsync(dirpath)
+            self._newdirs.clear()
+        if after:
+            after()
+        self.progress.wrote(dstpath, size)
+
+    def _flush(self):
+        """Sync the files of the current batch to disk, publish them,
+        sync their directories and record the sources whose logs were
+        all published"""
+        batch, self._batch = self._batch, []
+        records, self._batch_records = self._batch_records, []
+        if not batch:
+            return
+
+        self._curpath = self.destination
+        try:
+            util.sync_files([x[0] for x in batch], self.destination)
+        except Exception as e:
+            # nothing was published, so nothing is recorded
+            self.progress.error(self._curpath)
+            return
+
+        dirpaths = set(self._newdirs)
+        self._newdirs.clear()
+        failed = set()
+        for tmppath, path, dstpath, after, source in batch:
+            self._curpath = path
+            try:
+                size = os.path.getsize(tmppath)
+                published = self._publish(tmppath, path)
+                self.tempfiles.remove(tmppath)
+                if not published:
+                    self.progress.existing(dstpath)
+                    continue
+                dirpaths.add(dirname(path))
+                if after:
+                    after()
+                self.progress.wrote(dstpath, size)
+            except Exception as e:
+                failed.add(source)
+                self.progress.error(self._curpath)
+
+        self._curpath = self.destination
+        try:
+            util.sync_files(dirpaths, self.destination)
+            for source, args in records:
+                if source not in failed:
+                    self._state.record(*args)
+        except Exception as e:
+            self.progress.error(self._curpath)
+
+    def _publish(self, tmppath, path):
+        """Move tmppath to path.
+        Return False if path was created by someone else first"""
+        if self.force:
+            os.rename(tmppath, path)
+            return True
+
+        # link fails if path exists, so concurrent workers writing the
+        # same log can't clobber each other without a shared lock
+        try:
+            os.link(tmppath, path)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                os.unlink(tmppath)
+                return False
+            elif e.errno in (errno.EPERM, errno.EXDEV, errno.EOPNOTSUPP):
+                # no hard link support
+                os.rename(tmppath, path)
+                return True
+            raise
+        os.unlink(tmppath)
+
+        return True
 
     def run(self):
         signal.signal(signal.SIGINT, signal.SIG_IGN)
-        path = ''
-        while True:
+        self.progress.set_worker(self.index)
+        if not self.profile:
+            self._run()
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(self._run)
+        finally:
+            profile.dump_stats(join(self.profile, '%s.pstats' % self.name))
+
+    def _run(self):
+        if self._state:
+            self._state.open()
+            util.imagesizes.store = self._state
+        while not self.stopped:
             try:
-                path = self.queue.get()
-                if path is None:
-                    break
-                self._process_path(path)
-            except IOError as e:
+                paths = self.queue.get()
+            except (IOError, EOFError) as e:
+                break
+            if paths is None:
                 break
-            except Exception as e:
-                self.progress.error(self._curpath)
 
+            for path in paths:
+                if self.stopped:
+                    break
+                try:
+                    self._process_path(path)
+                except Exception as e:
+                    self.progress.error(self._curpath)
+                self.progress.done(path)
+            self._flush()
+
+        dircache = util.dircache
+        print_d('%s: directory cache %i hits, %i misses, '
+                '%i system calls saved' %
+                (self.name, dircache.hits, dircache.misses, dircache.saved))
+        if self.image_store:
+            print_d('%s: image store %i stored, %i placed, %i identical' %
+                    (self.name, self.image_store.nstored,
+                     self.image_store.nplaced, self.image_store.nidentical))
+        self.progress.image_sizes(util.imagesizes.hits,
+                                  util.imagesizes.misses)
+        if self.results:
+            self.results.put(self.timings)
         self.cleanup()
 
 def isfileordir(value):
@@ -195,6 +543,16 @@ def isfileordir(value):
 
     return value
 
+def fraction(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise ArgumentTypeError("'%s' is not a number" % value)
+    if not 0 <= number <= 1:
+        raise ArgumentTypeError("'%s' is not between 0 and 1" % value)
+
+    return number
+
 def isnotfile(value):
     if isfile(value):
         raise ArgumentTypeError("'%s' is not a file" % value)
@@ -230,11 +588,72 @@ def parse_args():
                         action='store_true',
                         default=False,
                         )
+    parser.add_argument("-p", "--passthrough",
+                        help=_("copy (or hard link) logs that are already "
+                               "in the output format instead of "
+                               "converting them"),
+                        choices=['copy', 'link'],
+                        nargs='?',
+                        const='copy',
+                        default=None,
+                        )
+    parser.add_argument("--verify", metavar="FRACTION",
+                        help=_("compare FRACTION of the logs copied with "
+                               "--passthrough against their sources"),
+                        type=fraction,
+                        default=0.0,
+                        )
+    parser.add_argument("--image-store",
+                        help=_("keep one copy of each distinct image in "
+                               "DESTINATION/%s and hard link it into "
+                               "conversation directories") %
+                        imagestore.DIRNAME,
+                        action='store_true',
+                        default=False,
+                        )
+    parser.add_argument("--durability",
+                        help=_("when to sync written logs to disk: "
+                               "'none' leaves it to the system, 'batch' "
+                               "syncs each batch of logs together and "
+                               "'strict' syncs every log and its directory "
+                               "before going on (default: %(default)s)"),
+                        choices=['none', 'batch', 'strict'],
+                        default='none',
+                        )
+    parser.add_argument("--report", metavar="PATH",
+                        help=_("write a JSON report of the time spent in "
+                               "each stage of processing, by format, to "
+                               "PATH"),
+                        default=None,
+                        )
+    parser.add_argument("--profile", metavar="DIR",
+                        help=_("profile workers and write their stats, "
+                               "combined stats and a summary to DIR"),
+                        type=isnotfile,
+                        default=None,
+                        )
     parser.add_argument("--no-comments",
                         help=_("do not write comments to converted logs"),
                         action='store_true',
                         default=False,
                         )
+    parser.add_argument("--no-state",
+                        help=_("do not record or consult the sync state "
+                               "stored at destination"),
+                        action='store_true',
+                        default=False,
+                        )
+    parser.add_argument("--rebuild-state",
+                        help=_("discard and regenerate the sync state "
+                               "stored at destination"),
+                        action='store_true',
+                        default=False,
+                        )
+    parser.add_argument("--ordered",
+                        help=_("process source files in sorted order"),
+                        action='store_true',
+                        default=False,
+                        )
     parser.add_argument("-q", "--quiet",
                         help=_("suppress warnings"),
                         action='store_true',
@@ -265,37 +684,166 @@ def parse_args():
 
     return options
 
+def get_state(options):
+    """Return SyncState for destination, or None if disabled"""
+    if options.no_state:
+        return None
+
+    state = SyncState(options.destination, readonly=const.DRYRUN)
+    if const.DRYRUN:
+        return state if isfile(state.path) and not options.rebuild_state \
+            else None
+
+    if not exists(options.destination):
+        os.makedirs(options.destination)
+    state.create(rebuild=options.rebuild_state)
+
+    return state
+
+def get_chunks(paths, queue):
+    """Yield lists of paths to hand to workers
+
+    Chunks start small so all workers get going quickly, double in size
+    while work is still queued and halve when workers are starved.
+    """
+    chunk = []
+    nbytes = 0
+    limit = 1
+    for path in paths:
+        chunk.append(path)
+        try:
+            nbytes += os.lstat(path).st_size
+        except OSError:
+            pass
+        if len(chunk) >= limit or nbytes >= CHUNK_BYTES:
+            yield chunk
+            if queue.empty():
+                limit = max(limit // 2, 1)
+            else:
+                limit = min(limit * 2, CHUNK_FILES)
+            chunk = []
+            nbytes = 0
+
+    if chunk:
+        yield chunk
+
+def put(queue, item, progress):
+    """Put item in queue, redrawing progress while waiting, and raise
+    WorkerError if every worker exits before there is room"""
+    while True:
+        try:
+            queue.put(item, timeout=Progress.REDRAW_INTERVAL)
+            break
+        except Full:
+            if not any(w.is_alive() for w in WORKERS):
+                raise WorkerError('all workers exited')
+        finally:
+            progress.print_status()
+
 def convert(paths, options):
     global WORKERS
-    manager = Manager()
-    fslock = Lock()
-    progress = Progress()
-    queue = manager.Queue()
-    files = manager.dict()
-
+    progress = Progress(options.threads)
+    # bounded so discovery does not run arbitrarily far ahead of workers
+    queue = Queue(options.threads * 4)
+    results = Queue() if options.report else None
+    state = get_state(options)
+    if options.profile and not isdir(options.profile):
+        os.makedirs(options.profile)
+
+    image_store = imagestore.ImageStore(options.destination) \
+        if options.image_store else None
     WORKERS = [Parser(options.format, options.force, options.destination,
-                      queue, files, progress, fslock)
+                      queue, progress, state, options.passthrough,
+                      options.verify, image_store, options.durability, i,
+                      results, options.profile)
                for i in range(options.threads)]
 
     for w in WORKERS:
         w.start()
 
-    for path in paths:
-        queue.put(path)
+    for chunk in get_chunks(paths, queue):
+        progress.ndiscovered += len(chunk)
+        put(queue, chunk, progress)
+    progress.discovering = False
 
     for w in WORKERS:
-        queue.put(None)
+        put(queue, None, progress)
 
-    for w in WORKERS:
-        w.join()
+    timings = wait(progress, results)
+    if options.report:
+        write_report(options.report, progress, timings)
+    if options.profile:
+        merge_profiles(options.profile, [w.name for w in WORKERS])
 
     return 0
 
-def main(options):
-    print_('gathering paths...', end='', flush=True, file=sys.stderr)
-    src_paths = util.get_paths(options.source)
-    print_('done', file=sys.stderr)
+def wait(progress, results):
+    """Wait for workers to finish, redrawing progress meanwhile, and
+    return their merged timings if results is set. Raise WorkerError if
+    a worker did not exit cleanly."""
+    timings = timing.Timings()
+    pending = len(WORKERS) if results else 0
+    for w in WORKERS:
+        while w.is_alive():
+            if pending:
+                # workers cannot exit until their timings are read
+                try:
+                    timings.merge(results.get(
+                        timeout=Progress.REDRAW_INTERVAL))
+                    pending -= 1
+                except Empty:
+                    pass
+            else:
+                w.join(Progress.REDRAW_INTERVAL)
+            progress.print_status()
+    while pending:
+        try:
+            timings.merge(results.get_nowait())
+        except Empty:
+            break
+        pending -= 1
+    for w in WORKERS:
+        if w.exitcode:
+            raise WorkerError('%s exited with status %i' %
+                              (w.name, w.exitcode))
+
+    return timings
+
+def write_report(path, progress, timings):
+    report = timings.report()
+    report['elapsed'] = progress.elapsed
+    report['files'] = {'read': progress.nread,
+                       'wrote': progress.nwrote,
+                       'existing': progress.nexisting,
+                       'unchanged': progress.nunchanged,
+                       'skipped': progress.nskipped,
+                       'error': progress.nerror,
+                       }
+    report['bytes'] = {'read': progress.nbytes_read,
+                       'written': progress.nbytes_written,
+                       }
+    timing.write_report(path, report)
+    print_d('wrote report to %s' % path)
+
+def merge_profiles(directory, names):
+    """Merge the profiles of workers names in directory and write the
+    combined stats and a summary of them"""
+    paths = [join(directory, '%s.pstats' % x) for x in names]
+    paths = [x for x in paths if isfile(x)]
+    if not paths:
+        return
+
+    stats = pstats.Stats(*paths)
+    stats.dump_stats(join(directory, PROFILE_COMBINED))
+    with open(join(directory, PROFILE_SUMMARY), 'w') as f:
+        stats.stream = f
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        stats.sort_stats('time').print_stats(PROFILE_TOP)
+    print_v('profile of %i workers written to %s' %
+            (len(paths), join(directory, PROFILE_SUMMARY)))
 
+def main(options):
+    src_paths = util.iter_paths(options.source, ordered=options.ordered)
     convert(src_paths, options)
 
     return 0
@@ -305,14 +853,25 @@ def cleanup(exitcode):
     for w in WORKERS:
         progress = w.progress
         w.stop()
+    if WORKERS:
+        # wake up idle workers; queued chunks are abandoned
+        queue = WORKERS[0].queue
+        queue.cancel_join_thread()
+        for w in WORKERS:
+            try:
+                queue.put_nowait(None)
+            except Full:
+                break
     for w in WORKERS:
         w.join()
 
     if progress:
-        progress.print_status('done')
+        progress.print_status(force=True)
         exitcode += progress.nerror
     if not const.VERBOSE:
         print_('')
+    if progress:
+        progress.print_summary()
 
     return exitcode
 
@@ -28,3 +28,9 @@ VERBOSE = 'CHATLOGSYNC_VERBOSE' in os.environ
 QUIET = 'CHATLOGSYNC_QUIET' in os.environ
 DRYRUN = 'CHATLOGSYNC_DRYRUN' in os.environ
 NO_COMMENTS = 'CHATLOGSYNC_NO_COMMENTS' in os.environ
+
+CACHE_DIR = os.environ.get(
+    'CHATLOGSYNC_CACHE_DIR',
+    os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                os.path.expanduser(os.path.join('~', '.cache'))),
+                 PROGRAM_NAME))
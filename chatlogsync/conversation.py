@@ -36,10 +36,12 @@ else:
 import time
 import datetime
 from dateutil.tz import tzoffset
-from os.path import join, dirname, isfile, realpath
+from os.path import join, dirname
 
+from lxml import etree
 from bs4 import BeautifulSoup
-from bs4.element import NavigableString, PageElement
+from bs4.builder import builder_registry
+from bs4.element import NavigableString, PageElement, Tag, Comment
 
 from chatlogsync import util
 from chatlogsync.timezones import getoffset
@@ -52,6 +54,38 @@ def _validate_argument(arg, argname, cls):
         raise TypeError(msg % (cls.__name__, argname,
                                arg, type(arg).__name__))
 
+_XML_BUILDER = builder_registry.lookup('lxml', 'xml')()
+
+def get_soup_children(elem):
+    """Return contents of lxml element elem as a list of
+    BeautifulSoup elements"""
+    children = []
+    if elem.text:
+        children.append(NavigableString(elem.text))
+    for child in elem:
+        if isinstance(child, etree._Comment):
+            children.append(Comment(child.text))
+        elif isinstance(child.tag, basestring):
+            # lxml returns byte strings for ascii values on python 2
+            qname = etree.QName(child)
+            attrs = {unicode(k): unicode(v) for k, v in
+                     iter(child.attrib.items())}
+            tag = Tag(builder=_XML_BUILDER, name=unicode(qname.localname),
+                      namespace=qname.namespace, attrs=attrs)
+            for c in get_soup_children(child):
+                tag.append(c)
+            children.append(tag)
+        if child.tail:
+            children.append(NavigableString(child.tail))
+
+    return children
+
+def parse_markup(markup, xml=False):
+    """Return markup as a list of BeautifulSoup elements"""
+    if xml:
+        return get_soup_children(etree.fromstring('<foo>%s</foo>' % markup))
+    return list(BeautifulSoup('<foo>%s</foo>' % markup, 'lxml').foo.children)
+
 def _get_text(html):
     strings = []
     for x in html:
@@ -70,7 +104,11 @@ def _get_text(html):
     return ''.join(strings)
 
 class Conversation(object):
-    """Object representing a conversation from a chatlog"""
+    """Object representing a conversation from a chatlog
+
+    isgroup may be a callable, which is called to find out if the
+    conversation is a group chat when that is first needed.
+    """
     def __init__(self, parsedby, path, source, destination, service, time,
                  entries, images, resource='', isgroup=False, transforms={}):
         self._source = source
@@ -80,11 +118,12 @@ class Conversation(object):
         self._path = path
         self._parsedby = parsedby
         self._original_parser_name = None
-        self._isgroup = True if isgroup else False
+        self._isgroup = isgroup if callable(isgroup) else bool(isgroup)
+        self._strings = {}
 
         for argname in ('source', 'destination', 'service', 'path'):
             _validate_argument(getattr(self, '_'+argname), argname, basestring)
-        if not isfile(self._path):
+        if not util.dircache.isfile(self._path):
             raise ArgumentError("path '%s' does not exist" % path)
         _validate_argument(parsedby, 'parsedby', ChatlogFormat)
         self.__validate_time(time)
@@ -96,6 +135,11 @@ class Conversation(object):
             new_value = function(cur_value, self)
             setattr(self, '_'+attr, new_value)
 
+    def intern(self, string):
+        """Return the copy of string shared by this conversation, so
+        senders and aliases repeated across entries are stored once"""
+        return self._strings.setdefault(string, string)
+
     @property
     def original_parser_name(self):
         return self._original_parser_name
@@ -112,7 +156,17 @@ class Conversation(object):
 
     @property
     def isgroup(self):
+        if callable(self._isgroup):
+            self._isgroup = True if self._isgroup() else False
         return self._isgroup
+    @isgroup.setter
+    def isgroup(self, isgroup):
+        self._isgroup = True if isgroup else False
+    @property
+    def isgroup_known(self):
+        """True if isgroup is known without calling back"""
+        return not callable(self._isgroup)
+
     @property
     def source(self):
         return self._source
@@ -162,8 +216,8 @@ class Conversation(object):
         dirpath = dirname(self._path)
         for img_relpath in images:
             _validate_argument(img_relpath, 'images', basestring)
-            img_fullpath = realpath(join(dirpath, img_relpath))
-            if not isfile(img_fullpath):
+            img_fullpath = util.dircache.realpath(join(dirpath, img_relpath))
+            if not util.dircache.isfile(img_fullpath):
                 print_e('Skipping nonexistent image at %s' % img_fullpath)
             else:
                 self._images.append(img_relpath)
@@ -215,8 +269,19 @@ class Conversation(object):
         return True
 
 class Entry(object):
-    """Immutable object representing an entry in a Conversation"""
+    """Immutable object representing an entry in a Conversation
+
+    Pass validate=False to skip argument type checks for entries built
+    from trusted parser output.
+    """
+    # auto and type are accepted by every entry so parsers can pass the
+    # same attributes to each constructor
+    __slots__ = ('_alias', '_sender', '_text', '_time', '_delayed',
+                 '_alternate', '_html', '_isuser', '_system', '_auto',
+                 '_type', '_raw_html', '_raw_xml')
+
     def __init__(self, **kwargs):
+        validate = kwargs.pop('validate', True)
         self._alias = ''
         self._sender = ''
         self._text = ''
@@ -225,16 +290,25 @@ class Entry(object):
         self._alternate = False
         self._html = []
         self._isuser = False
+        # unparsed markup for html, turned into elements on first use
+        self._raw_html = None
+        self._raw_xml = False
 
         for k, v in iter(kwargs.items()):
             setattr(self, '_'+k, v)
 
         self._system = True if kwargs.get('system', None) else False
-        if self._text and not self._html:
+        if self._raw_html is not None:
+            if validate:
+                _validate_argument(self._raw_html, 'raw_html', basestring)
+            self._html = None
+        elif self._text and not self._html:
             self._html = [NavigableString(self._text)]
 
-        for argname in ('alias', 'sender', 'text'):
-            _validate_argument(getattr(self, '_'+argname), argname, basestring)
+        if validate:
+            for argname in ('alias', 'sender', 'text'):
+                _validate_argument(getattr(self, '_'+argname), argname,
+                                   basestring)
 
         if self._system:
             self._alias = ''
@@ -243,17 +317,21 @@ class Entry(object):
             raise ArgumentError('non-system Entry must have sender or alias')
         elif self._alias == self._sender:
             self._alias = ''
-        _validate_argument(self._time, 'time', datetime.datetime)
-        _validate_argument(self._html, 'html', list)
-        for e in self._html:
-            _validate_argument(e, 'html', PageElement)
+
+        if validate:
+            _validate_argument(self._time, 'time', datetime.datetime)
+            if self._html is not None:
+                _validate_argument(self._html, 'html', list)
+                for e in self._html:
+                    _validate_argument(e, 'html', PageElement)
 
     def __eq__(self, other):
         if other.__class__ != self.__class__:
             return False
         equal = True
         for k, v in iter(vars(other.__class__).items()):
-            if isinstance(v, property) and \
+            # unparsed markup is compared through the parsed properties
+            if isinstance(v, property) and not k.startswith('raw_') and \
                     getattr(self, k) != getattr(other, k):
                 equal = False
                 break
@@ -263,13 +341,26 @@ class Entry(object):
     def __ne__(self, other):
         return not self == other
 
+    def _attributes(self):
+        """Return dict of the attributes that are set"""
+        d = {}
+        for cls in self.__class__.__mro__[:-1]:
+            for k in cls.__slots__:
+                try:
+                    d[str(k)] = getattr(self, k)
+                except AttributeError:
+                    pass
+        return d
+
     def dump(self):
         d = {}
-        for k, v in iter(vars(self).items()):
+        for k, v in iter(self._attributes().items()):
             if k.startswith("_"):
                 k = k[1:]
+            if k.startswith('raw_'):
+                continue
             if 'html' in k:
-                v = [str(v) for v in v]
+                v = [str(v) for v in getattr(self, k)]
             d[k] = v
         return "%s %r" % (self.__class__.__name__, d)
 
@@ -298,8 +389,18 @@ class Entry(object):
         return self._time
     @property
     def html(self):
+        if self._html is None:
+            self._html = parse_markup(self._raw_html, self._raw_xml)
         return self._html
     @property
+    def raw_html(self):
+        """Markup html was parsed from, or None"""
+        return self._raw_html
+    @property
+    def raw_xml(self):
+        """True if raw markup is XML rather than HTML"""
+        return self._raw_xml
+    @property
     def system(self):
         return self._system
     @property
@@ -319,7 +420,7 @@ class Entry(object):
         return self._text
 
     def __repr__(self):
-        return "%s(%r)" % (self.__class__, self.__dict__)
+        return "%s(%r)" % (self.__class__, self._attributes())
 
     def __str__(self):
         t = self.time.strftime('%X') if self.time else ''
@@ -333,6 +434,8 @@ class Entry(object):
 
 class Message(Entry):
     """Immutable object representing a message in a Conversation"""
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         self._auto = kwargs.get('auto', False)
         super(Message, self).__init__(**kwargs)
@@ -361,6 +464,8 @@ class Status(Entry):
     SYSTEM = 9
     MOBILE = 10
 
+    __slots__ = ('_msg_text', '_msg_html', '_raw_msg_html', '_has_other_html')
+
     SYSTEM_STATUSES = (SYSTEM,)
     OPPOSITES = { OFFLINE: ONLINE,
                   ONLINE: (OFFLINE, IDLE, MOBILE),
@@ -397,6 +502,7 @@ class Status(Entry):
     def __init__(self,  **kwargs):
         self._msg_text = ''
         self._msg_html = []
+        self._raw_msg_html = None
         atype = kwargs.get('type', None)
         if atype < self._MIN or atype > self._MAX:
             raise TypeError("unknown type %r for status" % atype)
@@ -408,7 +514,13 @@ class Status(Entry):
             kwargs['system'] = True
 
         super(Status, self).__init__(**kwargs)
-        self._has_other_html = True if self._html else False
+        self._has_other_html = \
+            True if self._html or self._raw_html is not None else False
+        if self._raw_msg_html is not None:
+            if kwargs.get('validate', True):
+                _validate_argument(self._raw_msg_html, 'raw_msg_html',
+                                   basestring)
+            self._msg_html = None
 
     @property
     def typestr(self):
@@ -422,14 +534,23 @@ class Status(Entry):
 
     @property
     def msg_html(self):
+        if self._msg_html is None:
+            self._msg_html = parse_markup(self._raw_msg_html, self._raw_xml)
         return self._msg_html
 
+    @property
+    def raw_msg_html(self):
+        """Markup msg_html was parsed from, or None"""
+        return self._raw_msg_html
+
     @property
     def has_other_html(self):
         return self._has_other_html
 
     @property
     def html(self):
+        if self._html is None:
+            self._html = parse_markup(self._raw_html, self._raw_xml)
         if not self._html:
             self._html = []
             if self.type in self.USER_TYPES:
@@ -452,6 +573,8 @@ class Status(Entry):
 
 class Event(Entry):
     """Immutable object representing an event in a Conversation"""
+    __slots__ = ()
+
     WINDOWCLOSED = 1
     WINDOWOPENED = 2
 
@@ -22,3 +22,7 @@ class ParseError(Exception):
     """Raised when there is an error parsing data"""
 class ArgumentError(Exception):
     """Raised when an invalid argument is encountered"""
+class VerificationError(Exception):
+    """Raised when a copied log does not match its source"""
+class WorkerError(Exception):
+    """Raised when no worker is left to take queued paths"""
@@ -22,7 +22,7 @@ from __future__ import absolute_import
 import traceback
 import sys
 from glob import glob
-from os.path import dirname, basename, join
+from os.path import dirname, basename, join, splitext
 
 base = dirname(__file__)
 self = basename(base)
@@ -48,10 +48,16 @@ for _name in modules:
 
 output_formats = []
 input_formats = []
+extensions = {} # file extension: [format types]
 for k, v in sorted(all_formats.items()):
     input_formats.append(k)
     if 'write' in vars(v):
         output_formats.append(k)
+    extensions.setdefault(v.FILE_EXTENSION, []).append(k)
+
+def claimants(path):
+    """Return types of the formats that may be able to parse path"""
+    return extensions.get(splitext(path)[1], []) + extensions.get(None, [])
 
 def get(type):
     """Return a constructor for a chatlog format given the format type"""
@@ -18,11 +18,13 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
-import re
-import datetime
+import time
 import shutil
 from os.path import dirname, join, realpath
 
+from chatlogsync import util
+from chatlogsync.imagestore import identical
+
 class ChatlogFormat(object):
     type = 'unknown format'
     SERVICE_MAP = {}
@@ -32,10 +34,16 @@ class ChatlogFormat(object):
     EVENT_TYPEMAP = {}
     PAMEPYT_TNEVE = {}
     FILE_PATTERN = ''
+    # extension of log files, or None if logs may have any extension
+    FILE_EXTENSION = None
     TIME_FMT_FILE = ''
     TRANSFORMS = {}
     UNTRANSFORMS = {}
     IMAGE_DIRECTORY = ''
+    # ImageStore that images are copied through, if any
+    image_store = None
+    # Timings that the time spent copying images is added to, if any
+    timings = None
 
     def __init__(self):
         if not self.PAM_ECIVRES:
@@ -47,16 +55,31 @@ class ChatlogFormat(object):
         if not self.PAMEPYT_TNEVE:
             self.PAMEPYT_TNEVE = {v: k for (k, v) in
                                   iter(self.EVENT_TYPEMAP.items())}
+        if self.FILE_PATTERN:
+            self.file_template = util.get_template(self.FILE_PATTERN,
+                                                   path=True)
 
     def copy_images(self, path, conversation):
         if not self.IMAGE_DIRECTORY:
             raise NotImplementedError
 
+        start = time.time()
         dstdir = join(dirname(path), self.IMAGE_DIRECTORY)
         for img_relpath, srcpath in conversation.images_full:
             dstpath = join(dstdir, img_relpath)
-            if srcpath != realpath(dstpath):
+            if srcpath == realpath(dstpath):
+                continue
+            if self.image_store:
+                self.image_store.place(srcpath, dstpath)
+            elif not identical(srcpath, dstpath):
                 shutil.copy(srcpath, dstpath)
+        if self.timings:
+            self.timings.add(self.type, 'copy_images', time.time() - start)
+
+    def get_images(self, conversation):
+        """Return list of (relative path, full path) of images referred to
+        by the log of conversation, without parsing its entries"""
+        return conversation.images_full
 
     def get_path(self, conversation):
         if not self.FILE_PATTERN:
@@ -69,24 +92,15 @@ class ChatlogFormat(object):
         if (not self.SERVICE_MAP):
             raise NotImplementedError
 
-        s = re.split('{(.*?)}', pattern)
-        for i in range(1, len(s), 2):
-            item = s[i].split(' ', 1)
-            attr = item[0]
-            value = getattr(conversation, attr)
-            if untransform and attr in self.UNTRANSFORMS:
-                value = self.UNTRANSFORMS[attr](value, conversation)
-
-            if len(item) == 2:
-                value = item[1].replace(attr, str(value)) if value else ''
-
-            if attr == 'service':
-                value = self.PAM_ECIVRES[value]
-            elif isinstance(value, datetime.datetime):
-                value = value.strftime(time_fmt)
-            s[i] = value
+        untransforms = self.UNTRANSFORMS if untransform else {}
+        return util.get_template(pattern).render(conversation, time_fmt,
+                                                 self.PAM_ECIVRES,
+                                                 untransforms)
 
-        return ''.join(s)
+    def claims(self, path):
+        """Cheaply check whether path could be a log in this format,
+        without touching the filesystem."""
+        return True
 
     def parse_path(self, path):
         """Parse path and return list of conversations without
@@ -20,20 +20,23 @@ from __future__ import absolute_import
 
 # TODO: handle <action>
 
-import os
 import re
 import codecs
 import shutil
 import datetime
-from os.path import join, dirname, relpath
+from functools import partial
+from os.path import join, dirname
 
-from bs4 import BeautifulSoup
+from xml.sax.saxutils import escape
+
+from lxml import etree
 from bs4.element import Tag, Comment, NavigableString
 
 from chatlogsync import util, const
 from chatlogsync.formats._base import ChatlogFormat
 from chatlogsync.errors import ParseError
-from chatlogsync.conversation import Conversation, Message, Status, Event
+from chatlogsync.conversation import Conversation, Message, Status, Event, \
+    unicode
 from chatlogsync.timezones import getoffset
 
 class Adium(ChatlogFormat):
@@ -69,6 +72,7 @@ class Adium(ChatlogFormat):
         '{destination} ({time}).chatlog',
         '{destination} ({time}).xml'
     )
+    FILE_EXTENSION = '.xml'
     IMAGE_DIRECTORY = '.'
     TIME_FMT_FILE = '%Y-%m-%dT%H.%M.%S%z'
     STRPTIME_FMT_FILE = '%Y-%m-%dT%H.%M.%S'
@@ -94,7 +98,14 @@ class Adium(ChatlogFormat):
                    if c.service == 'facebook' else s),
     }
 
+    # bytes read by parse_path to find the chat element and early senders
+    HEADER_SIZE = 1 << 12
+    # bytes read at a time when scanning a whole log for senders
+    SCAN_SIZE = 1 << 16
+
     SENDER_RE = re.compile('<[^<>]*sender="(?P<sender>.*?)".*?>')
+    GROUPCHAT_RE = re.compile('<chat[^<>]*groupchat="true"')
+    IMG_RE = re.compile('<img', re.IGNORECASE)
     IMGTAG_RE = re.compile('<img (.*?)([/]?)>(.*)')
     TIMESTR_RE = re.compile('^(?P<ts1>.*)(?P<ts2>[-+][\d:]+)$')
 
@@ -109,18 +120,37 @@ class Adium(ChatlogFormat):
         dt = datetime.datetime.strptime(ts1, fmt)
         return dt.replace(tzinfo=getoffset(None, ts2))
 
-    def _isgroup(self, lines, path, source, destination):
-        senders = set((source, destination, None))
-        if 'groupchat="true"' in lines[1]:
+    def _isgroup(self, text, senders):
+        """Return True if text marks the chat as a group chat or has a
+        sender that is not in senders"""
+        if self.GROUPCHAT_RE.search(text):
             return True
-        for line in lines:
-            m = self.SENDER_RE.search(line)
-            if m and m.group('sender') not in senders:
+        for m in self.SENDER_RE.finditer(text):
+            if m.group('sender') not in senders:
                 return True
         return False
 
+    def _scan_isgroup(self, path, senders):
+        """Return True if the log at path is a group chat, reading it
+        SCAN_SIZE bytes at a time"""
+        rest = ''
+        with codecs.open(path, encoding='utf-8', errors='ignore') as f:
+            while True:
+                block = f.read(self.SCAN_SIZE)
+                if not block:
+                    return self._isgroup(rest, senders)
+                text = rest + block
+                # a tag cut by the end of the block is matched with the next
+                i = text.rfind('<')
+                text, rest = (text[:i], text[i:]) if i >= 0 else (text, '')
+                if self._isgroup(text, senders):
+                    return True
+
+    def claims(self, path):
+        return dirname(path).endswith('.chatlog')
+
     def parse_path(self, path):
-        info = util.parse_string(path, self.FILE_PATTERN, path=True)
+        info = self.file_template.match(path)
         if not info:
             return None
 
@@ -129,49 +159,78 @@ class Adium(ChatlogFormat):
         service = self.SERVICE_MAP[info['service']]
         source = info['source']
 
-        with codecs.open(path, encoding='utf-8') as f:
-            data = f.read().strip()
-            lines = data.split('\n')
-        isgroup = self._isgroup(lines, path, source, destination)
+        # only the header is read here; unless it shows a group chat,
+        # detection finishes in parse_conversation or on first use
+        with open(path, 'rb') as f:
+            header = f.read(self.HEADER_SIZE)
+        complete = len(header) < self.HEADER_SIZE
+        header = header.decode('utf-8', 'ignore')
+        if not complete and '<' in header:
+            # leave out the tag cut by the end of the header
+            header = header[:header.rfind('<')]
+        senders = set((source, destination, None))
+        if self._isgroup(header, senders):
+            isgroup = True
+        else:
+            isgroup = partial(self._scan_isgroup, path, senders)
 
         dp = join(dirname(path), self.IMAGE_DIRECTORY)
-        images = [relpath(join(dp, x), start=dp) for x in os.listdir(dp)
-                  if not x.endswith('.xml')]
+        images = [x for x in util.dircache.listdir(dp)
+                  if not x.endswith('.xml') and
+                  util.dircache.isfile(join(dp, x))]
 
         # create conversation with tranformed source
         conversation = Conversation(self, path, source, destination,
                                     service, time, entries=[], images=images,
                                     isgroup=isgroup,
                                     transforms=self.TRANSFORMS)
-        conversation.lines = lines
 
         return [conversation]
 
     def parse_conversation(self, conversation):
-        lines = conversation.lines
-        xml_header = lines.pop(0)
         conversation.original_parser_name = self.type
-        for e in BeautifulSoup(lines.pop(0), ['lxml', 'xml']).children:
-            if isinstance(e, Comment):
-                conversation.original_parser_name = e.split('/')[1]
-            else:
-                service = self.SERVICE_MAP[e.get('service')]
-                source = e.get('account')
-                conversation.resource = e.get('resource')
+        source = transformed_source = service = None
+        comment = None
+        latest_time = conversation.time
+        chat = None
+
+        events = etree.iterparse(conversation.path,
+                                 events=('start', 'end', 'comment'),
+                                 recover=True, huge_tree=True)
+        for event, elem in events:
+            if event == 'comment':
+                if chat is None:
+                    conversation.original_parser_name = \
+                        unicode(elem.text).split('/')[1]
+                elif elem.getparent() is chat:
+                    comment = unicode(elem.text)
+                # comments nested in an entry are part of its markup
+                continue
+            elif chat is None:
+                chat = elem
+                service = self.SERVICE_MAP[elem.get('service')]
+                source = unicode(elem.get('account'))
+                conversation.resource = unicode(elem.get('resource', ''))
                 transformed_source = \
                     self.TRANSFORMS['source'](source, conversation)
+                if transformed_source != conversation.source or \
+                        service != conversation.service:
+                    raise ParseError("mismatch between path and chatinfo "
+                                     "for '%s" % conversation.path)
+                senders = set((source, conversation.destination, None))
+                if elem.get('groupchat') == 'true':
+                    conversation.isgroup = True
+                continue
+            elif event == 'start' or elem.getparent() is not chat:
+                continue
 
-        if transformed_source != conversation.source or \
-                service != conversation.service:
-            raise ParseError("mismatch between path and chatinfo for '%s" %
-                             conversation.path)
+            if not conversation.isgroup_known and \
+                    elem.get('sender') not in senders:
+                conversation.isgroup = True
 
-        latest_time = conversation.time
-        for line in lines:
-            if line == "</chat>":
-                continue
-            cons, attrs = self._parse_line(line, conversation, source,
-                                           transformed_source)
+            cons, attrs = self._parse_entry(elem, comment, conversation,
+                                            source, transformed_source)
+            comment = None
             if attrs['time'] < latest_time:
                 attrs['delayed'] = True
             else:
@@ -180,62 +239,96 @@ class Adium(ChatlogFormat):
             try:
                 conversation.entries.append(cons(**attrs))
             except Exception as err:
-                print_e("Problem with element %s" % e)
+                print_e("Problem with element %s" % etree.tostring(elem))
                 raise err
 
+            # entries are no longer needed once parsed
+            elem.clear()
+            while elem.getprevious() is not None:
+                del chat[0]
+
+        if chat is None:
+            raise ParseError("no chat element found in '%s'" %
+                             conversation.path)
+        if not conversation.isgroup_known:
+            conversation.isgroup = False
+
         return conversation
 
-    def _parse_line(self, line, conversation, source, transformed_source):
-        """Return (cons, attrs)"""
+    def _parse_entry(self, elem, comment, conversation, source,
+                     transformed_source):
+        """Return (cons, attrs) for an entry element and the comment
+        preceding it"""
         status_html = []
         attrs = {}
-        cons = None
-
-        for elem in BeautifulSoup(line, ['lxml', 'xml']).children:
-            if isinstance(elem, Comment):
-                alternate, status_html = elem.split('|', 1)
-                attrs['alternate'] = True if alternate else False
-                status_html = [NavigableString(status_html)]
-                continue
-
-            for key in ('alias', 'sender', 'auto', 'time'):
-                attrs[key] = elem.get(key, '')
-
-            if attrs['sender'] == source:
-                attrs['sender'] = transformed_source
-                attrs['isuser'] = True
-            else:
-                attrs['isuser'] = False
-
-            attrs['auto'] = bool(attrs['auto'])
-            if attrs['time']:
-                fmt = self.STRPTIME_FMT_CONVERSATION
-                attrs['time'] = self._parse_time(attrs['time'], fmt)
-
-            attrs['html'] =  list(elem.children)
-
-            if elem.name == 'status':
-                cons = Status
-                attrs['type'] = self.STATUS_TYPEMAP.get(elem.get('type'), None)
-                if attrs['type'] in Status.USER_TYPES:
+        name = etree.QName(elem).localname
+
+        if comment is not None:
+            alternate, status_html = comment.split('|', 1)
+            attrs['alternate'] = True if alternate else False
+            status_html = [NavigableString(status_html)]
+
+        # lxml returns byte strings for ascii values on python 2
+        for key in ('alias', 'sender', 'auto', 'time'):
+            attrs[key] = unicode(elem.get(key, ''))
+        attrs['alias'] = conversation.intern(attrs['alias'])
+
+        if attrs['sender'] == source:
+            attrs['sender'] = transformed_source
+            attrs['isuser'] = True
+        else:
+            attrs['sender'] = conversation.intern(attrs['sender'])
+            attrs['isuser'] = False
+
+        attrs['auto'] = bool(attrs['auto'])
+        if attrs['time']:
+            fmt = self.STRPTIME_FMT_CONVERSATION
+            attrs['time'] = self._parse_time(attrs['time'], fmt)
+
+        markup = self._get_markup(elem)
+        if markup:
+            attrs['raw_html'] = markup
+            attrs['raw_xml'] = True
+        else:
+            attrs['html'] = []
+
+        if name == 'status':
+            cons = Status
+            attrs['type'] = self.STATUS_TYPEMAP.get(elem.get('type'), None)
+            if attrs['type'] in Status.USER_TYPES:
+                if markup:
+                    attrs['raw_msg_html'] = attrs.pop('raw_html')
+                else:
                     attrs['msg_html'] = attrs['html']
-                    attrs['html'] = status_html
-            elif elem.name == 'event':
-                cons = Event
-                attrs['type'] = self.EVENT_TYPEMAP.get(elem.get('type'), None)
-            elif elem.name == 'message':
-                cons = Message
-            else:
-                raise TypeError("unknown type '%s' for entry" % elem.name)
+                attrs['html'] = status_html
+        elif name == 'event':
+            cons = Event
+            attrs['type'] = self.EVENT_TYPEMAP.get(elem.get('type'), None)
+        elif name == 'message':
+            cons = Message
+        else:
+            raise TypeError("unknown type '%s' for entry" % name)
+
+        if not attrs['sender'] and not attrs['alias']:
+            print_d("%s is a system entry" % etree.tostring(elem))
+            attrs['system'] = True
+        attrs['validate'] = False
 
-            if not attrs['sender'] and not attrs['alias']:
-                print_d("%s is a system entry" % elem)
-                attrs['system'] = True
+        return cons, attrs
 
-        if not cons:
-            raise(ParseError("could not parse line: '%s'" % line))
+    def _get_markup(self, elem):
+        """Return contents of lxml element elem as an XML string"""
+        parts = [escape(elem.text)] if elem.text else []
+        for child in elem:
+            parts.append(etree.tostring(child, encoding=unicode,
+                                        with_tail=True))
+        markup = ''.join(parts)
+        if len(elem):
+            # children are serialized with the namespace of the chat
+            namespace = etree.QName(elem).namespace
+            markup = markup.replace(' xmlns="%s"' % namespace, '')
 
-        return cons, attrs
+        return markup
 
     def write(self, path, conversations):
         if len(conversations) != 1:
@@ -245,7 +338,7 @@ class Adium(ChatlogFormat):
                 )
         conversation = conversations[0]
 
-        file_object = codecs.open(path, 'wb', 'utf-8')
+        file_object = util.ChunkedWriter(path)
         file_object.write(self.XML_HEADER+'\n')
         untransformed_source = self.UNTRANSFORMS['source'](conversation.source,
                                                            conversation)
@@ -254,8 +347,11 @@ class Adium(ChatlogFormat):
                      resource=conversation.resource)
 
         # this attribute will only be useful if we're not the original parser
+        # or the senders do not show that this is a group chat
+        senders = set((conversation.source, conversation.destination, None))
         if conversation.isgroup and \
-                conversation.original_parser_name != self.type:
+                (conversation.original_parser_name != self.type or
+                 all(x.sender in senders for x in conversation.entries)):
             attrs['groupchat'] = "true"
 
         util.write_comment(file_object, const.HEADER_COMMENT %
@@ -308,8 +404,15 @@ class Adium(ChatlogFormat):
             if [x for x in comment if x]:
                 util.write_comment(file_object, '|'.join(comment))
 
-            self._write_xml(file_object, name, attrs, conversation,
-                            contents=getattr(entry, htmlattr))
+            # markup from another adium log can be written as is unless
+            # image sizes need to be filled in
+            raw = getattr(entry, 'raw_'+htmlattr)
+            if raw and entry.raw_xml and not self.IMG_RE.search(raw):
+                self._write_xml(file_object, name, attrs, conversation,
+                                raw=raw)
+            else:
+                self._write_xml(file_object, name, attrs, conversation,
+                                contents=getattr(entry, htmlattr))
             if i != len(conversation.entries)-1:
                 file_object.write('\n')
 
@@ -319,7 +422,7 @@ class Adium(ChatlogFormat):
         self.copy_images(path, conversation)
 
     def _write_xml(self, file_object, name, attrs, conversation,
-                   contents=[], close=True):
+                   contents=[], close=True, raw=None):
         attrlist = []
         for n in self.ATTRS[name]:
             v = attrs.get(n, None)
@@ -327,6 +430,9 @@ class Adium(ChatlogFormat):
                 attrlist.append((n, v))
         attrstr = " ".join(['%s="%s"' % (n,v)  for n, v in attrlist])
         file_object.write("<%s %s>" % (name, attrstr))
+        if raw is not None:
+            file_object.write(raw)
+            contents = []
 
         for elem in contents:
             if isinstance(elem, NavigableString) or isinstance(elem, Comment):
@@ -22,7 +22,7 @@ import re
 import sys
 import codecs
 import datetime
-from os.path import join, dirname, relpath, realpath
+from os.path import join, dirname, basename, relpath, realpath, isfile
 
 from dateutil.parser import parse
 from bs4 import BeautifulSoup
@@ -54,6 +54,7 @@ class PidginHtml(ChatlogFormat):
         '{destination}{isgroup .chat}',
         '{time}.html'
     )
+    FILE_EXTENSION = '.html'
     TIME_FMT_FILE = '%Y-%m-%d.%H%M%S%z%Z'
     STRPTIME_FMT_FILE = '%Y-%m-%d.%H%M%S'
     TITLE_PATTERN = _("Conversation with {destination} "
@@ -98,7 +99,11 @@ class PidginHtml(ChatlogFormat):
     COMMENT_RE = re.compile('^%s(?P<commentstr>.*?)%s' % (Comment.PREFIX,
                                                           Comment.SUFFIX))
 
+    IMG_RE = re.compile('<img', re.IGNORECASE)
+    IMG_SRC_RE = re.compile('<img [^>]*?src="(.*?)"', re.IGNORECASE)
     PATH_TIME_RE = re.compile('(.*)([+-]\d{4})(.*)')
+    # e.g. 2011-12-09.011343-0800PST.html
+    FILE_NAME_RE = re.compile('\d{4}-\d{2}-\d{2}\.\d{6}')
 
     TIME_FMT_CONVERSATION = "(%X)"
     TIME_FMT_CONVERSATION_WITH_DATE = "(%x %X)"
@@ -125,9 +130,19 @@ class PidginHtml(ChatlogFormat):
     def __init__(self, *args):
         super(PidginHtml, self).__init__(*args)
         self.TIME_FMT_TITLE = timezones.locale_datetime_fmt
+        self._title_template = util.get_template(self.TITLE_PATTERN)
+        self._time_parser = util.TimeParser()
+        self._status_templates = [(util.get_template(k), v) for k, v in
+                                  iter(self.STATUS_TYPEMAP.items())]
+        self._chat_status_templates = self._status_templates + \
+            [(util.get_template(k), v) for k, v in
+             iter(self.CHAT_STATUS_TYPEMAP.items())]
+
+    def claims(self, path):
+        return self.FILE_NAME_RE.match(basename(path)) is not None
 
     def parse_path(self, path):
-        info = util.parse_string(path, self.FILE_PATTERN, path=True)
+        info = self.file_template.match(path)
         if not info:
             return None
 
@@ -144,6 +159,19 @@ class PidginHtml(ChatlogFormat):
 
         return [conversation]
 
+    def get_images(self, conversation):
+        with codecs.open(conversation.path, encoding='utf-8') as f:
+            data = f.read()
+
+        dirpath = dirname(conversation.path)
+        images = []
+        for img_relpath in set(self.IMG_SRC_RE.findall(data)):
+            img_fullpath = realpath(join(dirpath, img_relpath))
+            if isfile(img_fullpath):
+                images.append((img_relpath, img_fullpath))
+
+        return images
+
     def _get_line_data(self, line):
         """Return (line, comment)"""
         data = self.COMMENT_RE.split(line)
@@ -157,6 +185,7 @@ class PidginHtml(ChatlogFormat):
         return l, comment
 
     def parse_conversation(self, conversation):
+        self._time_parser = util.TimeParser()
         with codecs.open(conversation.path, encoding='utf-8') as f:
             data = f.read().strip()
             lines = data.split('\n')
@@ -221,6 +250,8 @@ class PidginHtml(ChatlogFormat):
         conversation.entries, conversation.images = \
             self._get_entries_and_images(conversation, senders_by_alias,
                                          attrs_list)
+        print_d('%s: %.1f%% of timestamps parsed with a known format' %
+                (conversation.path, self._time_parser.hit_rate * 100))
 
         return conversation
 
@@ -243,13 +274,19 @@ class PidginHtml(ChatlogFormat):
                 attrs['alias'] = ''
             if 'isuser' not in attrs:
                 attrs['isuser'] = attrs['sender'] == conversation.source
-
-            for h in (x for x in attrs['html'] if isinstance(x, Tag)):
-                if h.name == 'img':
-                    images.append(h.get('src'))
-                else:
-                    images.extend([x.get('src') for x in h.find_all('img')])
-            entries.append(cons(**attrs))
+            attrs['sender'] = conversation.intern(attrs['sender'])
+            attrs['alias'] = conversation.intern(attrs['alias'])
+            attrs.setdefault('validate', False)
+
+            entry = cons(**attrs)
+            if entry.raw_html is None or self.IMG_RE.search(entry.raw_html):
+                for h in (x for x in entry.html if isinstance(x, Tag)):
+                    if h.name == 'img':
+                        images.append(h.get('src'))
+                    else:
+                        images.extend([x.get('src')
+                                       for x in h.find_all('img')])
+            entries.append(entry)
 
         return entries, list(set(images))
 
@@ -293,6 +330,7 @@ class PidginHtml(ChatlogFormat):
         # unrepresentable entry dump
         if not line:
             cons, attrs = Entry.from_dump(comment)
+            attrs['validate'] = True
             return cons, attrs
 
         matched = False
@@ -333,11 +371,10 @@ class PidginHtml(ChatlogFormat):
         elif regex == self.ERROR_LINE_RE:
             timestr = m.group('time')
             htmlstr = m.group('html')
-            attrs['color'] = self.ERROR_COLOR
             cons = Status
             attrs['type'] = Status.ERROR
 
-        parsed = parse(timestr, default=datetime.datetime.min, ignoretz=True)
+        parsed = self._time_parser.parse(timestr)
         # delayed has full date in timestamp
         if parsed.date() == datetime.date.min:
             attrs['delayed'] = False
@@ -350,8 +387,13 @@ class PidginHtml(ChatlogFormat):
             attrs['time'] = parsed.replace(tzinfo=base_time.tzinfo)
 
 
-        attrs['html'] = \
-            list(BeautifulSoup('<foo>%s</foo>' % htmlstr).foo.children)
+        if cons == Message:
+            # parsed only if needed
+            del attrs['html']
+            attrs['raw_html'] = htmlstr
+        else:
+            attrs['html'] = \
+                list(BeautifulSoup('<foo>%s</foo>' % htmlstr).foo.children)
 
         # parse status
         if cons == Status:
@@ -381,10 +423,10 @@ class PidginHtml(ChatlogFormat):
             if s.startswith(_("You")) else None
 
         if not info['type']:
-            typemap = dict(self.STATUS_TYPEMAP, **self.CHAT_STATUS_TYPEMAP) if \
-                conversation.isgroup else self.STATUS_TYPEMAP
-            for pattern, t in iter(typemap.items()):
-                i = util.parse_string(s, pattern)
+            templates = self._chat_status_templates if \
+                conversation.isgroup else self._status_templates
+            for template, t in templates:
+                i = template.match(s)
                 if i is not None:
                     for k, v in iter(i.items()):
                         info[k] = v
@@ -399,7 +441,7 @@ class PidginHtml(ChatlogFormat):
 
     def _parse_title(self, line, comment, conversation):
         m = self.TITLE_LINE_RE.match(line)
-        info = util.parse_string(m.group('titlestr'), self.TITLE_PATTERN)
+        info = self._title_template.match(m.group('titlestr'))
         self._parse_info(info, conversation)
         original_parser_name = comment.split('/')[1] if comment else self.type
 
@@ -425,7 +467,7 @@ class PidginHtml(ChatlogFormat):
                 )
 
         conversation = conversations[0]
-        file_object = codecs.open(path, 'wb', 'utf-8')
+        file_object = util.ChunkedWriter(path)
         util.write_comment(file_object, const.HEADER_COMMENT %
                            conversation.original_parser_name)
         self._write_title(file_object, conversation)
@@ -487,6 +529,11 @@ class PidginHtml(ChatlogFormat):
             util.write_comment(file_object, entry.dump())
 
     def _write_entry_html(self, file_object, entry):
+        # markup from an XML log is also valid here
+        if entry.raw_html:
+            file_object.write(entry.raw_html)
+            return
+
         for elem in entry.html:
             if isinstance(elem, NavigableString) or isinstance(elem, Comment):
                 elem.setup() # workaround for BeautifulSoup issue
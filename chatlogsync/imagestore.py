@@ -0,0 +1,99 @@
+# Copyright 2013 Evan Vitero
+
+# This file is part of chatlogsync.
+
+# chatlogsync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# chatlogsync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with chatlogsync.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import errno
+import filecmp
+from os.path import join, exists, dirname, splitext, samefile
+
+from chatlogsync import util
+from chatlogsync.syncstate import get_hash
+
+DIRNAME = '.chatlogsync-images'
+
+def identical(path1, path2):
+    """Return True if path1 and path2 exist and have the same contents"""
+    try:
+        if samefile(path1, path2):
+            return True
+        return filecmp.cmp(path1, path2, shallow=False)
+    except OSError:
+        return False
+
+class ImageStore(object):
+    """Content-addressed store of images under a destination
+
+    Each distinct image is stored once, named by the sha1 of its
+    contents, and placed in conversation directories as a hard link (or
+    a reflinked copy where hard links are not possible).
+    """
+    def __init__(self, destination):
+        self.path = join(destination, DIRNAME)
+        self._digests = {}
+        self.nstored = 0
+        self.nplaced = 0
+        self.nidentical = 0
+
+    def add(self, srcpath):
+        """Store the image at srcpath if needed and return its path in
+        the store"""
+        st = os.stat(srcpath)
+        key = (srcpath, st.st_size, st.st_mtime)
+        try:
+            digest = self._digests[key]
+        except KeyError:
+            digest = self._digests[key] = get_hash(srcpath)
+
+        storepath = join(self.path, digest[:2],
+                         digest+splitext(srcpath)[1].lower())
+        if exists(storepath):
+            return storepath
+
+        try:
+            os.makedirs(dirname(storepath))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmppath = '%s.%i.tmp' % (storepath, os.getpid())
+        util.copy_file(srcpath, tmppath)
+        try:
+            # another worker may have stored the same image first
+            os.link(tmppath, storepath)
+            self.nstored += 1
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                os.unlink(tmppath)
+                raise
+        os.unlink(tmppath)
+
+        return storepath
+
+    def place(self, srcpath, dstpath):
+        """Make dstpath a copy of the image at srcpath, unless it already
+        has the same contents"""
+        storepath = self.add(srcpath)
+        if identical(storepath, dstpath):
+            self.nidentical += 1
+            return
+
+        tmppath = '%s.%i.tmp' % (dstpath, os.getpid())
+        util.copy_file(storepath, tmppath, link=True)
+        os.rename(tmppath, dstpath)
+        self.nplaced += 1
@@ -0,0 +1,143 @@
+# Copyright 2013 Evan Vitero
+
+# This file is part of chatlogsync.
+
+# chatlogsync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# chatlogsync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with chatlogsync.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import hashlib
+import sqlite3
+from os.path import join, exists
+
+FILENAME = '.chatlogsync.sqlite'
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS sources '
+    '(path TEXT, format TEXT, size INTEGER, mtime REAL, hash TEXT, '
+    'PRIMARY KEY (path, format))',
+    'CREATE TABLE IF NOT EXISTS destinations '
+    '(path TEXT, format TEXT, destination TEXT)',
+    'CREATE INDEX IF NOT EXISTS destinations_source '
+    'ON destinations (path, format)',
+    'CREATE TABLE IF NOT EXISTS images '
+    '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+    'width INTEGER, height INTEGER)',
+)
+
+def get_hash(path):
+    """Return sha1 hex digest of the contents of path"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class SyncState(object):
+    """Persistent record of source logs already synced to a destination
+
+    Each source path is stored with its size, mtime and content hash
+    for a given output format, along with the destination paths that
+    were produced from it.  The dimensions of source images are kept
+    as well.
+    """
+    def __init__(self, destination, readonly=False):
+        self.destination = destination
+        self.path = join(destination, FILENAME)
+        self.readonly = readonly
+        self._conn = None
+
+    def create(self, rebuild=False):
+        """Create the store, discarding existing state if rebuild is set"""
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        if rebuild:
+            conn.execute('DROP TABLE IF EXISTS sources')
+            conn.execute('DROP TABLE IF EXISTS destinations')
+            conn.execute('DROP TABLE IF EXISTS images')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+
+    def open(self):
+        self._conn = sqlite3.connect(self.path, timeout=60)
+        # commits are frequent, so only sync the log at checkpoints
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+
+    def close(self):
+        if self._conn:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+    def unchanged(self, path, st, fmt):
+        """Return True if path was synced in format fmt and has not
+        changed since. st is the result of os.stat(path)."""
+        row = self._conn.execute(
+            'SELECT size, mtime, hash FROM sources '
+            'WHERE path = ? AND format = ?', (path, fmt)).fetchone()
+        if not row:
+            return False
+
+        size, mtime, digest = row
+        if size != st.st_size:
+            return False
+        # logs removed from the destination must be written again
+        for (destination,) in self._conn.execute(
+                'SELECT destination FROM destinations '
+                'WHERE path = ? AND format = ?', (path, fmt)):
+            if not exists(join(self.destination, destination)):
+                return False
+        if mtime == st.st_mtime:
+            return True
+
+        # touched, but possibly not modified
+        if get_hash(path) != digest:
+            return False
+        if not self.readonly:
+            self._execute('UPDATE sources SET mtime = ? '
+                          'WHERE path = ? AND format = ?',
+                          (st.st_mtime, path, fmt))
+        return True
+
+    def record(self, path, st, fmt, destinations):
+        """Record that path was synced in format fmt to destinations"""
+        self._conn.execute('DELETE FROM destinations '
+                           'WHERE path = ? AND format = ?', (path, fmt))
+        self._conn.executemany('INSERT INTO destinations VALUES (?, ?, ?)',
+                               [(path, fmt, d) for d in destinations])
+        self._execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)',
+                      (path, fmt, st.st_size, st.st_mtime, get_hash(path)))
+
+    def get_image_size(self, path, size, mtime):
+        """Return (width, height) recorded for the image at path, or None
+        if it has changed since"""
+        row = self._conn.execute(
+            'SELECT width, height FROM images '
+            'WHERE path = ? AND size = ? AND mtime = ?',
+            (path, size, mtime)).fetchone()
+        return tuple(row) if row else None
+
+    def record_image_size(self, path, size, mtime, dimensions):
+        if not self.readonly:
+            self._execute('INSERT OR REPLACE INTO images '
+                          'VALUES (?, ?, ?, ?, ?)',
+                          (path, size, mtime) + tuple(dimensions))
+
+    def _execute(self, statement, args):
+        # commit right away so other workers never wait long on the
+        # write lock
+        self._conn.execute(statement, args)
+        self._conn.commit()
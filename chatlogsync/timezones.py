@@ -18,14 +18,26 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
+import os
 import locale
 import time
 import re
 import sys
+import errno
 import pytz
+import tempfile
 import collections
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import datetime as dt
+import dateutil
 import dateutil.tz as dtz
+from dateutil.tz.tz import TZPATHS
+from os.path import join
+
+from chatlogsync import const
 
 # timezones in same country have higher priority
 
@@ -36,6 +48,14 @@ tzoffsets_s = {}
 country_timezones = []
 locale_datetime_fmt = None
 
+# tzinfo objects returned by getoffset, keyed by its arguments
+_offsets = {}
+OFFSETS_CACHE_SIZE = 1024
+
+# bump when the layout of the cached tables changes
+CACHE_VERSION = 1
+CACHE_FILENAME = 'timezones.pickle'
+
 def init():
     global locale_datetime_fmt
 
@@ -44,6 +64,10 @@ def init():
         print_d('timezones already initialized')
         return
 
+    start = time.time()
+    # results from before the tables were filled in
+    _offsets.clear()
+
     # use system locale for %c in strftime
     locale.setlocale(locale.LC_ALL, '')
     locale_datetime_fmt = locale.nl_langinfo(locale.D_T_FMT)
@@ -55,6 +79,14 @@ def init():
     if not country:
         print_w('Unable to determine country: '
                 'timezone abbreviations may not be what you want')
+
+    key = _get_cache_key(country)
+    cache_path = join(const.CACHE_DIR, CACHE_FILENAME)
+    if _load_cache(cache_path, key):
+        print_d('timezones loaded from cache in %.1fms' %
+                ((time.time() - start) * 1000))
+        return
+
     country_timezones = pytz.country_timezones[country]
 
     for name in pytz.common_timezones:
@@ -69,6 +101,63 @@ def init():
     for k in iter(tznames.keys()):
         tznames[k].sort(key=_sort_func)
 
+    _save_cache(cache_path, key)
+    print_d('timezones computed in %.1fms' % ((time.time() - start) * 1000))
+
+def _get_tzdata_version():
+    """Return a string identifying the zoneinfo files used by gettz"""
+    for path in TZPATHS:
+        try:
+            with open(join(path, 'tzdata.zi')) as f:
+                return f.readline().strip()
+        except IOError:
+            pass
+        try:
+            return '%s %s' % (path, os.stat(path).st_mtime)
+        except OSError:
+            pass
+
+    # dateutil falls back to its bundled zoneinfo
+    return 'dateutil-%s' % dateutil.__version__
+
+def _get_cache_key(country):
+    return (CACHE_VERSION, sys.version_info[0], _get_tzdata_version(),
+            pytz.OLSON_VERSION, locale.setlocale(locale.LC_TIME), country,
+            tuple(time.tzname))
+
+def _load_cache(path, key):
+    """Fill the tables from the cache at path if it was made for key.
+    Return True on success."""
+    try:
+        with open(path, 'rb') as f:
+            cached_key, tables = pickle.load(f)
+    except (IOError, EOFError, ValueError, TypeError,
+            pickle.UnpicklingError) as e:
+        if getattr(e, 'errno', None) != errno.ENOENT:
+            print_d('unable to read timezone cache %s: %s' % (path, e))
+        return False
+    if cached_key != key:
+        print_d('timezone cache %s is stale' % path)
+        return False
+
+    for table, cached in zip((tznames, tzabbrevs, tzoffsets_i, tzoffsets_s),
+                             tables):
+        table.clear()
+        table.update(cached)
+    return True
+
+def _save_cache(path, key):
+    tables = (tznames, tzabbrevs, tzoffsets_i, tzoffsets_s)
+    try:
+        if not os.path.isdir(const.CACHE_DIR):
+            os.makedirs(const.CACHE_DIR)
+        fd, tmppath = tempfile.mkstemp(dir=const.CACHE_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((key, tables), f, 2)
+        os.rename(tmppath, path)
+    except (IOError, OSError) as e:
+        print_d('unable to write timezone cache %s: %s' % (path, e))
+
 def _update_lists(name, dt_obj, abbrevs):
     abbrev = dt_obj.strftime('%Z')
     if abbrev in abbrevs:
@@ -104,7 +193,25 @@ def _sort_func(entry):
     return 0
 
 def getoffset(abbrev, offset):
-    """Return a dateutil.tz.tzoffset object"""
+    """Return a dateutil.tz.tzoffset object
+
+    tzoffset objects are shared between calls with the same arguments.
+    """
+    key = (abbrev, offset)
+    try:
+        return _offsets[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable offset
+        return _getoffset(abbrev, offset)
+
+    if len(_offsets) >= OFFSETS_CACHE_SIZE:
+        _offsets.clear()
+    tzinfo = _offsets[key] = _getoffset(abbrev, offset)
+    return tzinfo
+
+def _getoffset(abbrev, offset):
     if not abbrev:
         abbrev = tznames.get(offset, [None, None])[0][1]
 
@@ -0,0 +1,136 @@
+# Copyright 2013 Evan Vitero
+
+# This file is part of chatlogsync.
+
+# chatlogsync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# chatlogsync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with chatlogsync.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import math
+import heapq
+import codecs
+
+# histogram buckets per doubling of duration
+BUCKETS_PER_OCTAVE = 4
+# shortest duration told apart by histograms, in seconds
+RESOLUTION = 1e-6
+SLOWEST = 10
+
+class Histogram(object):
+    """Log-scale histogram of durations in seconds"""
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > RESOLUTION:
+            i = int(math.log(seconds / RESOLUTION, 2) * BUCKETS_PER_OCTAVE)
+        else:
+            i = 0
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding percentile p"""
+        rank = self.count * p / 100
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(RESOLUTION * 2 ** ((i + 1) / BUCKETS_PER_OCTAVE),
+                           self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'total': self.total,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max,
+                }
+
+class Timings(object):
+    """Durations of the stages of processing files, by format
+
+    A worker keeps its own Timings; the parent merges them into one
+    for the report.
+    """
+    def __init__(self):
+        self.histograms = {}
+        # (seconds, path) of the slowest files, as a heap
+        self.slowest = []
+
+    def add(self, fmt, stage, seconds):
+        key = (fmt, stage)
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(seconds)
+
+    def total(self, fmt, stage):
+        histogram = self.histograms.get((fmt, stage))
+        return histogram.total if histogram else 0.0
+
+    def add_file(self, path, seconds):
+        if len(self.slowest) < SLOWEST:
+            heapq.heappush(self.slowest, (seconds, path))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, path))
+
+    def merge(self, other):
+        for key, histogram in other.histograms.items():
+            try:
+                self.histograms[key].merge(histogram)
+            except KeyError:
+                self.histograms[key] = histogram
+        for seconds, path in other.slowest:
+            self.add_file(path, seconds)
+
+    def report(self):
+        """Return dict of per-format and per-stage summaries and the
+        slowest files"""
+        formats = {}
+        stages = {}
+        for (fmt, stage), histogram in self.histograms.items():
+            formats.setdefault(fmt, {})[stage] = histogram.summary()
+            if stage not in stages:
+                stages[stage] = Histogram()
+            stages[stage].merge(histogram)
+
+        return {'formats': formats,
+                'stages': {k: v.summary() for k, v in stages.items()},
+                'slowest': [{'path': p, 'seconds': s} for s, p in
+                            sorted(self.slowest, reverse=True)],
+                }
+
+def write_report(path, report):
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(json.dumps(report, indent=2, sort_keys=True,
+                           ensure_ascii=False))
+        f.write('\n')
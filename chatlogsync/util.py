@@ -20,70 +20,494 @@ from __future__ import absolute_import
 
 import os
 import re
+import errno
+import shutil
 import datetime
-from os.path import join, isfile, sep
+from collections import OrderedDict
+from os.path import join, split, normpath, isfile, isdir, islink, realpath, sep
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# linux ioctl for cloning a file's data blocks
+FICLONE = 0x40049409
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (ImportError, OSError):
+    _libc = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from bs4.element import Comment
+from dateutil.parser import parse as dateutil_parse
 from PIL import Image
 
 from chatlogsync import const
 from chatlogsync.errors import ParseError
 
 def get_image_size(fullpath):
-    """Return (width, height)"""
+    """Return (width, height) of the image at real path fullpath"""
+    return imagesizes.get(fullpath)
+
+def _read_image_size(fullpath):
+    # PIL only parses the header until the image data is needed
     with open(fullpath, 'rb') as fp:
         im = Image.open(fp)
     return im.size
 
+def _reflink(src, dst):
+    """Try to make dst share src's data blocks; return True on success"""
+    if not fcntl:
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+def copy_file(srcpath, dstpath, link=False):
+    """Copy srcpath to dstpath, or hard link it if link is set.
+
+    Copies are reflinked where the filesystem supports it, and otherwise
+    done in the kernel with copy_file_range if available."""
+    if link:
+        try:
+            os.link(srcpath, dstpath)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EXDEV, errno.EOPNOTSUPP):
+                raise
+
+    with open(srcpath, 'rb') as src:
+        with open(dstpath, 'wb') as dst:
+            if _reflink(src, dst):
+                return
+            if hasattr(os, 'copy_file_range'):
+                size = os.fstat(src.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(),
+                                           size - offset)
+                    if n == 0:
+                        break
+                    offset += n
+                if offset >= size:
+                    return
+                src.seek(offset)
+                dst.seek(offset)
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+def fsync(path):
+    """Flush the file or directory at path to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def syncfs(path):
+    """Flush the whole filesystem containing path to disk.
+    Return False if that is not supported."""
+    if not _libc or not hasattr(_libc, 'syncfs'):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _libc.syncfs(fd) == 0
+    finally:
+        os.close(fd)
+
+def sync_files(paths, root):
+    """Flush paths, which are all on the filesystem of root, to disk"""
+    paths = list(paths)
+    if len(paths) > 1 and syncfs(root):
+        return
+    for path in paths:
+        fsync(path)
+
 def write_comment(file_object, comment_text):
     if not const.NO_COMMENTS:
         comment = Comment(comment_text)
         comment.setup() # workaround for BeautifulSoup issue
         file_object.write(comment.output_ready())
 
+class ChunkedWriter(object):
+    """Text file writer that joins writes in memory and encodes and
+    writes them to path in chunks of about chunksize characters"""
+    def __init__(self, path, encoding='utf-8', chunksize=1 << 20):
+        self.encoding = encoding
+        self.chunksize = chunksize
+        self._file = open(path, 'wb')
+        self._parts = []
+        self._size = 0
+
+    def write(self, string):
+        self._parts.append(string)
+        self._size += len(string)
+        if self._size >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self._file.write(''.join(self._parts).encode(self.encoding))
+            self._parts = []
+            self._size = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class TimeParser(object):
+    """Parser for timestamps that share one unknown strftime format
+
+    The first timestamp is tried against FORMATS.  Formats that match are
+    remembered and tried first for later timestamps, and dateutil's
+    generic parser is only used when none of them match.  Timestamps
+    without a date get the date of datetime.min, like dateutil with
+    default=datetime.min.
+    """
+    FORMATS = (
+        '%X',
+        '%x %X',
+        '%I:%M:%S %p',
+        '%H:%M:%S',
+        '%x %I:%M:%S %p',
+        '%x %H:%M:%S',
+        '%Y-%m-%d %I:%M:%S %p',
+        '%Y-%m-%d %H:%M:%S',
+        '%m/%d/%Y %I:%M:%S %p',
+        '%m/%d/%Y %H:%M:%S',
+    )
+    DATE_DIRECTIVES = ('%x', '%c', '%d', '%m', '%y', '%Y', '%b', '%B', '%j')
+
+    def __init__(self, formats=FORMATS):
+        self._formats = formats
+        self._learned = [] # (format, has date)
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, timestr):
+        for fmt, hasdate in self._learned:
+            try:
+                parsed = datetime.datetime.strptime(timestr, fmt)
+            except ValueError:
+                continue
+            self.hits += 1
+            return parsed if hasdate else \
+                parsed.replace(year=1, month=1, day=1)
+
+        self.misses += 1
+        learned = [x[0] for x in self._learned]
+        for fmt in self._formats:
+            if fmt in learned:
+                continue
+            try:
+                parsed = datetime.datetime.strptime(timestr, fmt)
+            except ValueError:
+                continue
+            hasdate = [x for x in self.DATE_DIRECTIVES if x in fmt] != []
+            self._learned.append((fmt, hasdate))
+            return parsed if hasdate else \
+                parsed.replace(year=1, month=1, day=1)
+
+        return dateutil_parse(timestr, default=datetime.datetime.min,
+                              ignoretz=True)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+class Template(object):
+    """Compiled form of a pattern such as '{destination} ({time}).xml'
+
+    Fields are either '{attr}', matching any text, or '{attr text}',
+    matching text if present.  Use get_template to build templates so
+    they are only compiled once per pattern.
+    """
+    def __init__(self, pattern, path=False):
+        s = re.split('{(.*?)}', pattern)
+        self.pattern = pattern
+        self.fields = [] # (attr, optional text or None)
+        self._literals = s[0::2]
+        self._keys = {} # group name: attr
+        counts = {}
+        for i in range(0, len(s), 2):
+            s[i] = re.escape(s[i])
+        for i in range(1, len(s), 2):
+            item = s[i].split(' ', 1)
+            key = item[0]
+            if len(item) == 1:
+                c = '[^'+re.escape(sep)+']' if path else '.'
+                fmt = "(?P<%s%i>{}*?)".format(c)
+                self.fields.append((key, None))
+            else:
+                escaped_item = re.escape(item[1])
+                fmt = "(?P<%s%i>{})?".format(escaped_item)
+                self.fields.append((key, item[1]))
+
+            if key not in counts:
+                counts[key] = 0
+            counts[key] += 1
+
+            s[i] = fmt % (key, counts[key])
+            self._keys['%s%i' % (key, counts[key])] = key
+        self._regex = re.compile(''.join(s))
+
+    def match(self, string):
+        """Return dict of field values found in string or None"""
+        s = self._regex.search(string)
+        if not s:
+            return None
+
+        results = {}
+        for key, value in iter(s.groupdict().items()):
+            k = self._keys[key]
+            if k in results and results[k] != value:
+                raise ParseError("Problem parsing string '%s'" % string)
+            results[k] = value
+
+        return results
+
+    def render(self, conversation, time_fmt='', service_map={},
+               untransforms={}):
+        """Return pattern filled in with attributes of conversation"""
+        s = []
+        for literal, (attr, text) in zip(self._literals, self.fields):
+            value = getattr(conversation, attr)
+            if attr in untransforms:
+                value = untransforms[attr](value, conversation)
+
+            if text is not None:
+                value = text.replace(attr, str(value)) if value else ''
+
+            if attr == 'service':
+                value = service_map[value]
+            elif isinstance(value, datetime.datetime):
+                value = value.strftime(time_fmt)
+            s.append(literal)
+            s.append(value)
+        s.append(self._literals[-1])
+
+        return ''.join(s)
+
+_templates = {}
+def get_template(pattern, path=False):
+    """Return the Template for pattern, compiling it on first use"""
+    try:
+        return _templates[pattern, path]
+    except KeyError:
+        template = _templates[pattern, path] = Template(pattern, path)
+        return template
+
 def parse_string(string, pattern, path=False):
-    s = re.split('{(.*?)}', pattern)
-    counts = {}
-    for i in range(0, len(s), 2):
-        s[i] = re.escape(s[i])
-    for i in range(1, len(s), 2):
-        item = s[i].split(' ', 1)
-        key = item[0]
-        if len(item) == 1:
-            c = '[^'+re.escape(sep)+']' if path else '.'
-            fmt = "(?P<%s%i>{}*?)".format(c)
+    """Return dict of field values of pattern found in string or None"""
+    return get_template(pattern, path).match(string)
+
+def _scandir(path):
+    """Return list of (name, fullpath, isdir, islink) for the entries of
+    directory path. isdir is also set for symbolic links to directories."""
+    if scandir:
+        return [(e.name, e.path, e.is_dir(), e.is_symlink())
+                for e in scandir(path)]
+
+    entries = []
+    for name in os.listdir(path):
+        fullpath = join(path, name)
+        entries.append((name, fullpath, isdir(fullpath), islink(fullpath)))
+    return entries
+
+def _walk(top, ordered):
+    try:
+        entries = _scandir(top)
+    except OSError:
+        return
+    if ordered:
+        entries.sort()
+
+    for name, fullpath, isdirectory, symlink in entries:
+        if isdirectory:
+            # like os.walk, symbolic links to directories are not followed
+            if not symlink:
+                for p in _walk(fullpath, ordered):
+                    yield p
         else:
-            escaped_item = re.escape(item[1])
-            fmt = "(?P<%s%i>{})?".format(escaped_item)
-
-        if key not in counts:
-            counts[key] = 0
-        counts[key] += 1
-
-        s[i] = fmt % (key, counts[key])
-    regex_pattern = ''.join(s)
-    s = re.search(regex_pattern, string)
-    if not s:
-        return None
-
-    results = {}
-    for key, value in iter(s.groupdict().items()):
-        k = re.sub('\d', '', key)
-        if k in results and results[k] != value:
-            raise ParseError("Problem parsing string '%s'" % string)
-        results[k] = value
-
-    return results
-
-def get_paths(paths):
-    newpaths = set()
-    for path in paths:
+            yield fullpath
+
+def iter_paths(paths, ordered=False):
+    """Yield files in paths, descending into directories as they are found.
+
+    Sources contained in other sources are only walked once.  If ordered
+    is set, sources and directory entries are visited in sorted order.
+    """
+    if ordered:
+        paths = sorted(set(paths))
+    sources = [(realpath(x), x) for x in paths]
+
+    for i, (real, path) in enumerate(sources):
+        # skip duplicate sources and sources inside another source
+        if [r for r, p in sources[:i] if r == real] or \
+                [r for r, p in sources if real.startswith(r.rstrip(sep)+sep)]:
+            continue
+
         if isfile(path):
-            newpaths.add(path)
+            yield path
         else:
-            for root, dirs, files in os.walk(path):
-                for f in files:
-                    p = join(root, f)
-                    newpaths.add(p)
+            for p in _walk(path, ordered):
+                yield p
+
+class DirectoryCache(object):
+    """LRU cache of directory listings
+
+    Each directory is read once with scandir and kept as a snapshot of
+    its entries, so later listdir, isfile and realpath calls for paths in
+    it need no system calls.  Snapshots are never refreshed, so only use
+    it for directories that are not written to.
+    """
+    def __init__(self, size=128):
+        self.size = size
+        self._dirs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # system calls the uncached functions would have made, and made
+        self.ncalls = 0
+        self.nsyscalls = 0
+
+    @property
+    def saved(self):
+        """Estimated number of system calls avoided"""
+        return self.ncalls - self.nsyscalls
+
+    def _get(self, path):
+        """Return [entries, realpath] for directory path, where entries
+        maps names to [isfile, islink] (None where not known yet), or
+        None if path is not a directory"""
+        path = path or '.'
+        try:
+            snapshot = self._dirs.pop(path)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            snapshot = self._read(path)
+            if len(self._dirs) >= self.size:
+                self._dirs.popitem(last=False)
+        self._dirs[path] = snapshot
+
+        return snapshot
+
+    def _read(self, path):
+        self.nsyscalls += 1
+        try:
+            if scandir:
+                entries = {e.name: [e.is_file(), e.is_symlink()]
+                           for e in scandir(path)}
+            else:
+                entries = {name: [None, None] for name in os.listdir(path)}
+        except OSError:
+            return None
+
+        return [entries, None]
+
+    def _lookup(self, snapshot, dirpath, name, i):
+        """Return isfile (i=0) or islink (i=1) for name in snapshot"""
+        info = snapshot[0].get(name)
+        if info is None:
+            return False
+        if info[i] is None:
+            # listdir does not report file types
+            info[i] = (isfile, islink)[i](join(dirpath, name))
+            self.nsyscalls += 1
+        return info[i]
+
+    def invalidate(self, path):
+        """Forget the snapshot of directory path"""
+        self._dirs.pop(normpath(path) or '.', None)
+
+    def listdir(self, path):
+        """Return list of names in directory path"""
+        self.ncalls += 1
+        snapshot = self._get(normpath(path))
+        if snapshot is None:
+            raise OSError(errno.ENOENT, "No such directory: '%s'" % path)
+        return list(snapshot[0])
+
+    def isfile(self, path):
+        self.ncalls += 1
+        dirpath, name = split(normpath(path))
+        snapshot = self._get(dirpath)
+        if snapshot is None:
+            return False
+        return self._lookup(snapshot, dirpath, name, 0)
+
+    def realpath(self, path):
+        path = normpath(path)
+        # realpath lstats every component of the path
+        ncomponents = path.count(sep) + 1
+        self.ncalls += ncomponents
+        dirpath, name = split(path)
+        snapshot = None if '..' in path.split(sep) else self._get(dirpath)
+        if snapshot is None or self._lookup(snapshot, dirpath, name, 1):
+            self.nsyscalls += ncomponents
+            return realpath(path)
+
+        if snapshot[1] is None:
+            snapshot[1] = realpath(dirpath or '.')
+            self.nsyscalls += ncomponents - 1
+        return join(snapshot[1], name)
+
+dircache = DirectoryCache()
+
+class ImageSizeCache(object):
+    """LRU cache of image dimensions keyed by (path, size, mtime)
+
+    If store is set, dimensions missing from the cache are looked up
+    with store.get_image_size(path, size, mtime) and saved with
+    store.record_image_size(path, size, mtime, dimensions) before the
+    image itself is read.
+    """
+    def __init__(self, size=512, store=None):
+        self.size = size
+        self.store = store
+        self._sizes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fullpath):
+        """Return (width, height) of the image at fullpath"""
+        st = os.stat(fullpath)
+        key = (fullpath, st.st_size, st.st_mtime)
+        try:
+            dimensions = self._sizes.pop(key)
+            self.hits += 1
+        except KeyError:
+            dimensions = self.store.get_image_size(*key) \
+                if self.store else None
+            if dimensions:
+                self.hits += 1
+            else:
+                self.misses += 1
+                dimensions = _read_image_size(fullpath)
+                if self.store:
+                    self.store.record_image_size(*(key+(dimensions,)))
+            if len(self._sizes) >= self.size:
+                self._sizes.popitem(last=False)
+        self._sizes[key] = dimensions
+
+        return dimensions
 
-    return sorted(newpaths)
+imagesizes = ImageSizeCache()
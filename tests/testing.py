@@ -17,6 +17,7 @@
 
 from __future__ import print_function
 
+import json
 import shutil
 import subprocess
 import sys
@@ -25,6 +26,7 @@ import re
 import os
 import datetime
 import locale
+from contextlib import contextmanager
 from os.path import join, dirname, exists
 
 from dateutil.parser import parse
@@ -87,9 +89,11 @@ def convert_pidgin_times(path, revert=False):
     os.rename(path+'.tmp', path)
 
 def test_one(source_dir, source_ext, source_format, dest_ext, dest_format,
-             expected_dir=None, stop=True):
+             expected_dir=None, stop=True, args=()):
     sys.stdout.flush()
     titlestr = (CHAR*REPS +' %s -> %s') % (source_format, dest_format)
+    if args:
+        titlestr += ' (%s)' % ' '.join(args)
     print_(titlestr)
     sys.stdout.flush()
 
@@ -109,8 +113,8 @@ def test_one(source_dir, source_ext, source_format, dest_ext, dest_format,
     if exists(dest_dir):
         shutil.rmtree(dest_dir)
 
-    args = [CHATLOGSYNC, source_dir, dest_dir, '-f', dest_format]
-    n = subprocess.call(args)
+    n = subprocess.call([CHATLOGSYNC, source_dir, dest_dir, '-f',
+                         dest_format] + list(args))
     if n > 0:
         print_('chatlogsync failed', file=sys.stderr)
         return n
@@ -122,21 +126,22 @@ def test_one(source_dir, source_ext, source_format, dest_ext, dest_format,
     else:
         print_("unknown extension %r" % dest_ext)
 
-    args = [diffprog, dest_dir, expected_dir]
+    diffargs = [diffprog, dest_dir, expected_dir]
     if stop:
-        args.append('-s')
+        diffargs.append('-s')
 
     if dest_format == 'pidgin':
-        args.append('-p')
+        diffargs.append('-p')
     elif dest_format == 'adium':
-        args.append('-a')
+        diffargs.append('-a')
 
-    n += subprocess.call(args)
+    n += subprocess.call(diffargs)
 
     if n == 0 and not stop:
         print_(titlestr +': %i failures \n' % n)
         n += test_one(dest_dir, dest_ext, dest_basename, source_ext,
-                      source_format, expected_dir=source_dir, stop=True)
+                      source_format, expected_dir=source_dir, stop=True,
+                      args=args)
     else:
         print_(titlestr +': %i failures\n' % n)
 
@@ -150,6 +155,81 @@ def test_one(source_dir, source_ext, source_format, dest_ext, dest_format,
 
     return n
 
+@contextmanager
+def fixed_up(source_dir, source_format, dest_format):
+    """Apply the fixups of source_format to source_dir and yield an
+    empty destination directory; revert and remove both afterwards"""
+    dest_dir = join(dirname(__file__), '%s-to-%s' % (source_format,
+                                                     dest_format))
+    if exists(dest_dir):
+        shutil.rmtree(dest_dir)
+
+    sfunc, ext = APPLY_FUNCS.get(source_format, (None, None))
+    if sfunc:
+        apply_function(source_dir, ext, sfunc)
+    try:
+        yield dest_dir
+    finally:
+        if sfunc:
+            apply_function(source_dir, ext, sfunc, kwargs={'revert':True})
+        if exists(dest_dir):
+            shutil.rmtree(dest_dir)
+
+def run_sync(source_dir, dest_dir, dest_format, *args):
+    """Run chatlogsync and return its report, or None if it failed"""
+    report = dest_dir+'.json'
+    args = [CHATLOGSYNC, source_dir, dest_dir, '-f', dest_format, '-q',
+            '--report', report] + list(args)
+    if subprocess.call(args) > 0:
+        print_('chatlogsync failed', file=sys.stderr)
+        return None
+    with open(report) as fh:
+        report = json.load(fh)
+    os.unlink(dest_dir+'.json')
+
+    return report
+
+def test_resync(source_dir, source_format, dest_format):
+    """Check that syncing again only finds unchanged logs"""
+    titlestr = (CHAR*REPS +' %s -> %s (resync)') % (source_format,
+                                                      dest_format)
+    print_(titlestr)
+    with fixed_up(source_dir, source_format, dest_format) as dest_dir:
+        first = run_sync(source_dir, dest_dir, dest_format)
+        second = run_sync(source_dir, dest_dir, dest_format)
+
+    n = 0
+    if not first or not second:
+        n = 1
+    elif second['files']['read'] or second['files']['wrote'] or \
+            second['files']['unchanged'] != first['files']['read']:
+        print_('second sync was not a no-op: %r' % second['files'],
+               file=sys.stderr)
+        n = 1
+    print_(titlestr +': %i failures\n' % n)
+
+    return n
+
+def test_passthrough(source_dir, source_ext, source_format):
+    """Check that logs synced to their own format with --passthrough
+    are copies of their sources"""
+    titlestr = (CHAR*REPS +' %s -> %s (passthrough)') % (source_format,
+                                                           source_format)
+    print_(titlestr)
+    with fixed_up(source_dir, source_format, source_format) as dest_dir:
+        args = [CHATLOGSYNC, source_dir, dest_dir, '-f', source_format,
+                '-p', '--verify', '1']
+        n = subprocess.call(args)
+        if n > 0:
+            print_('chatlogsync failed', file=sys.stderr)
+        else:
+            diffprog = XMLDIFF if source_ext == 'xml' else HTMLDIFF
+            # walk the source, so logs that were not copied are failures
+            n = subprocess.call([diffprog, source_dir, dest_dir, '-s'])
+    print_(titlestr +': %i failures\n' % n)
+
+    return n
+
 def apply_function(directory, ext, func, kwargs={}):
     for root, dirs, files in os.walk(directory):
         for file in files:
@@ -163,6 +243,10 @@ def test_all(source_dir, source_ext, source_format, dest_ef_pairs):
     for dest_ext, dest_format in dest_ef_pairs:
         n += test_one(source_dir, source_ext, source_format,
                       dest_ext, dest_format, stop=False)
+        n += test_one(source_dir, source_ext, source_format,
+                      dest_ext, dest_format, args=['--durability', 'batch'])
+        n += test_resync(source_dir, source_format, dest_format)
+    n += test_passthrough(source_dir, source_ext, source_format)
 
     return n
 
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Copyright 2013 Evan Vitero
+
+# This file is part of chatlogsync.
+
+# chatlogsync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# chatlogsync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with chatlogsync.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import traceback
+import subprocess
+from os.path import join, dirname, abspath, exists
+from argparse import ArgumentParser
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+sys.path.insert(0, dirname(__file__))
+
+import chatlogsync
+from chatlogsync import formats
+import gencorpus
+
+PROG = 'benchmark'
+DESCRIPTION = ('Time chatlogsync converting generated corpora between '
+               'every pair of formats')
+
+SCRIPT = join(dirname(abspath(__file__)), '..', 'chatlogsync.py')
+# options of gencorpus that describe a corpus
+CORPUS_OPTIONS = ('seed', 'accounts', 'contacts', 'conversations',
+                  'entries')
+
+def threads(value):
+    return [int(x) for x in value.split(',')]
+
+def parse_args():
+    parser = ArgumentParser(prog=PROG, description=DESCRIPTION)
+    parser.add_argument("-t", "--threads", type=threads, default=[1, 2, 4],
+                        help="comma separated numbers of threads to run "
+                        "with (default: 1,2,4)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of runs of each benchmark, of which "
+                        "the fastest is kept (default: %(default)s)")
+    parser.add_argument("-o", "--output", metavar="PATH",
+                        help="write results as JSON to PATH")
+    parser.add_argument("-b", "--baseline", metavar="PATH",
+                        help="compare results with those saved in PATH")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fail if files/s drops by more than this "
+                        "fraction of the baseline (default: %(default)s)")
+    parser.add_argument("--workdir", metavar="DIR",
+                        help="keep generated corpora in DIR and reuse "
+                        "them between runs")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="seed of the generated corpora "
+                        "(default: %(default)s)")
+    parser.add_argument("--accounts", type=int, default=2,
+                        help="accounts in each corpus (default: %(default)s)")
+    parser.add_argument("--contacts", type=int, default=20,
+                        help="contacts per account (default: %(default)s)")
+    parser.add_argument("--conversations", type=int, default=10,
+                        help="conversations per contact "
+                        "(default: %(default)s)")
+    parser.add_argument("--entries", type=int, default=100,
+                        help="median entries per conversation "
+                        "(default: %(default)s)")
+    return parser.parse_args()
+
+def get_corpus(workdir, fmt, options):
+    """Return (path, info) of a corpus in format fmt, generating it
+    unless an identical one is in workdir"""
+    path = join(workdir, 'corpus-%s' % fmt)
+    info = {k: getattr(options, k) for k in CORPUS_OPTIONS}
+    info['format'] = fmt
+    infopath = join(workdir, 'corpus-%s.json' % fmt)
+    if exists(infopath):
+        with open(infopath) as f:
+            saved = json.load(f)
+        if {k: v for k, v in saved.items() if k in info} == info:
+            return path, saved
+        if exists(path):
+            shutil.rmtree(path)
+
+    args = [path, '-f', fmt] + ['--%s=%s' % (k, v) for k, v in
+                                sorted(info.items()) if k != 'format']
+    print('generating %s corpus' % fmt, file=sys.stderr)
+    generator = gencorpus.generate(gencorpus.parse_args(args))
+    info['nfiles'] = generator.nconversations
+    info['nentries'] = generator.nentries
+    info['nbytes'] = sum(os.path.getsize(join(d, x))
+                        for d, dirs, files in os.walk(path) for x in files)
+    with open(infopath, 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+    return path, info
+
+def run(source, destination, fmt, nthreads):
+    """Convert source to fmt in destination and return (seconds, peak
+    resident set size in bytes, report)"""
+    if exists(destination):
+        shutil.rmtree(destination)
+    report = destination+'.json'
+    args = [sys.executable, '-W', 'ignore', SCRIPT, source, destination,
+            '-f', fmt, '-t', str(nthreads), '-q', '--report', report]
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        p = subprocess.Popen(args, stdout=devnull, stderr=devnull)
+        # the usage of a child includes its own children, the workers
+        pid, status, usage = os.wait4(p.pid, 0)
+        seconds = time.time() - start
+    if status:
+        raise Exception("'%s' failed with status %i" %
+                        (' '.join(args), status))
+    maxrss = usage.ru_maxrss
+    maxrss = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    with open(report) as f:
+        report = json.load(f)
+
+    return seconds, maxrss, report
+
+def benchmark(options):
+    workdir = options.workdir or tempfile.mkdtemp(prefix=PROG)
+    if not exists(workdir):
+        os.makedirs(workdir)
+    try:
+        results = measure(workdir, options)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        return compare(results, baseline, options.threshold)
+    return 0
+
+def measure(workdir, options):
+    results = {'corpus': {k: getattr(options, k) for k in CORPUS_OPTIONS},
+               'results': []}
+    print('%-12s %-12s %7s %9s %11s %8s %9s' %
+          ('input', 'output', 'threads', 'files/s', 'entries/s', 'MB/s',
+           'peak MB'))
+    for infmt in sorted(formats.all_formats):
+        source, info = get_corpus(workdir, infmt, options)
+        for outfmt in formats.output_formats:
+            for nthreads in options.threads:
+                runs = [run(source, join(workdir, 'output'), outfmt, nthreads)
+                        for i in range(options.repeat)]
+                seconds = min(x[0] for x in runs)
+                maxrss = max(x[1] for x in runs)
+                report = runs[0][2]
+                if report['files']['error']:
+                    raise Exception('%i errors converting %s to %s' %
+                                    (report['files']['error'], infmt,
+                                     outfmt))
+                result = {'input': infmt,
+                          'output': outfmt,
+                          'threads': nthreads,
+                          'seconds': seconds,
+                          'files_per_s': report['files']['read'] / seconds,
+                          'entries_per_s': info['nentries'] / seconds,
+                          'mb_per_s': report['bytes']['read'] / seconds /
+                          (1 << 20),
+                          'peak_rss': maxrss,
+                          }
+                results['results'].append(result)
+                print('%-12s %-12s %7i %9.1f %11.0f %8.2f %9.1f' %
+                      (infmt, outfmt, nthreads, result['files_per_s'],
+                       result['entries_per_s'], result['mb_per_s'],
+                       maxrss / (1 << 20)))
+
+    return results
+
+def compare(results, baseline, threshold):
+    """Print changes in files/s from baseline and return the number of
+    benchmarks that got slower than threshold allows"""
+    if baseline['corpus'] != results['corpus']:
+        print('warning: baseline was measured on a different corpus',
+              file=sys.stderr)
+    key = lambda x: (x['input'], x['output'], x['threads'])
+    old = {key(x): x for x in baseline['results']}
+    nfailed = 0
+    for result in results['results']:
+        before = old.get(key(result))
+        if not before:
+            continue
+        change = result['files_per_s'] / before['files_per_s'] - 1
+        failed = change < -threshold
+        nfailed += failed
+        print('%-12s %-12s %7i %+8.1f%%%s' %
+              (key(result) + (change * 100, ' FAIL' if failed else '')))
+
+    return 1 if nfailed else 0
+
+if __name__ == "__main__":
+    options = parse_args()
+    exitcode = 0
+    try:
+        exitcode = benchmark(options)
+    except KeyboardInterrupt:
+        exitcode = 1
+        print("***aborted***", file=sys.stderr)
+    except Exception as e:
+        exitcode = 1
+        traceback.print_exc()
+    finally:
+        sys.exit(exitcode)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2013 Evan Vitero
+
+# This file is part of chatlogsync.
+
+# chatlogsync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# chatlogsync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with chatlogsync.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import sys
+import resource
+import traceback
+from os.path import join, dirname
+from argparse import ArgumentParser
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+import chatlogsync
+from chatlogsync import formats, timezones
+
+PROG = 'entrymem'
+DESCRIPTION = 'Report memory used per parsed entry of chat logs'
+
+def parse_args():
+    parser = ArgumentParser(prog=PROG, description=DESCRIPTION)
+    parser.add_argument("paths", metavar="PATH", nargs='+',
+                        help="log files to parse")
+    return parser.parse_args()
+
+def get_rss():
+    """Return resident set size in bytes, or the peak where the current
+    size is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def entrymem(options):
+    timezones.init()
+    modules = [t() for t in formats.all_formats.values()]
+    conversations = []
+    for path in options.paths:
+        for module in modules:
+            if module.claims(path):
+                conversations.extend(module.parse_path(path) or [])
+                break
+
+    gc.collect()
+    before = get_rss()
+    entries = []
+    for c in conversations:
+        c = c.parsedby.parse_conversation(c)
+        entries.extend(c.entries)
+    gc.collect()
+    used = get_rss() - before
+
+    n = len(entries)
+    print('%i entries, %i bytes, %.0f bytes/entry' %
+          (n, used, float(used) / n if n else 0))
+    return 0
+
+if __name__ == "__main__":
+    options = parse_args()
+    exitcode = 0
+    try:
+        exitcode = entrymem(options)
+    except KeyboardInterrupt:
+        exitcode = 1
+        print("***aborted***", file=sys.stderr)
+    except Exception as e:
+        exitcode = 1
+        traceback.print_exc()
+    finally:
+        sys.exit(exitcode)
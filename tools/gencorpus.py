@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# Copyright 2013 Evan Vitero
+
+# This file is part of chatlogsync.
+
+# chatlogsync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# chatlogsync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with chatlogsync.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import math
+import random
+import shutil
+import datetime
+import tempfile
+import traceback
+from os.path import join, dirname, isdir
+from argparse import ArgumentParser
+
+from PIL import Image
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+import chatlogsync
+from chatlogsync import const, formats, timezones
+from chatlogsync.timezones import getoffset
+from chatlogsync.conversation import Conversation, Message, Status, Event
+
+PROG = 'gencorpus'
+DESCRIPTION = 'Write a synthetic corpus of chat logs'
+
+# name of account number i and contact number j for each service
+NAMES = {
+    'aim': ('aimsource%i', 'aimdest%i'),
+    'gtalk': ('source%i@gmail.com', 'dest%i@gmail.com'),
+    'jabber': ('source%i@jabber.org', 'dest%i@jabber.org'),
+    'facebook': ('10000%i@chat.facebook.com', '-%i@chat.facebook.com'),
+}
+GROUP_NAMES = {
+    'aim': 'chat%i',
+    'gtalk': 'private-chat-%i@groupchat.google.com',
+    'jabber': 'room%i@conference.jabber.org',
+    'facebook': '-%i@chat.facebook.com',
+}
+# offsets whose abbreviations are unambiguous when read back
+TIMEZONES = (('PST', -28800), ('PDT', -25200))
+WORDS = ('hey', 'so', 'the', 'meeting', 'is', 'at', 'noon', 'lol', 'ok',
+         'sounds', 'good', 'see', 'you', 'there', 'did', 'get', 'my',
+         'message', 'yes', 'no', 'maybe', 'later', 'tomorrow', 'thanks',
+         '&amp;', 'what', 'about', 'dinner', 'sure', 'brb')
+ALIASES = ('Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace',
+           'Heidi', 'Ivan', 'Judy')
+START = datetime.datetime(2011, 1, 1)
+IMAGE_FILENAME = 'image%i.png'
+
+def fraction(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise ValueError(value)
+    return value
+
+def parse_args(args=None):
+    parser = ArgumentParser(prog=PROG, description=DESCRIPTION)
+    parser.add_argument("destination",
+                        help="directory to write logs to")
+    parser.add_argument("-f", "--format",
+                        choices=[str(x) for x in formats.output_formats],
+                        default='adium',
+                        help="format of the logs (default: %(default)s)")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="seed for the random number generator "
+                        "(default: %(default)s)")
+    parser.add_argument("--accounts", type=int, default=2,
+                        help="number of accounts (default: %(default)s)")
+    parser.add_argument("--contacts", type=int, default=10,
+                        help="contacts per account (default: %(default)s)")
+    parser.add_argument("--conversations", type=int, default=5,
+                        help="conversations per contact "
+                        "(default: %(default)s)")
+    parser.add_argument("--entries", type=int, default=50,
+                        help="median entries per conversation "
+                        "(default: %(default)s)")
+    parser.add_argument("--entries-sigma", type=float, default=1.0,
+                        help="spread of the log-normal distribution of "
+                        "entries per conversation; 0 gives every "
+                        "conversation the median (default: %(default)s)")
+    parser.add_argument("--group-ratio", type=fraction, default=0.1,
+                        help="fraction of conversations that are group "
+                        "chats (default: %(default)s)")
+    parser.add_argument("--status-ratio", type=fraction, default=0.05,
+                        help="fraction of entries that are status changes "
+                        "(default: %(default)s)")
+    parser.add_argument("--event-ratio", type=fraction, default=0.02,
+                        help="fraction of entries that are window events, "
+                        "in formats that have them (default: %(default)s)")
+    parser.add_argument("--delayed-ratio", type=fraction, default=0.01,
+                        help="fraction of messages that are delayed "
+                        "(default: %(default)s)")
+    parser.add_argument("--image-ratio", type=fraction, default=0.005,
+                        help="fraction of messages that are images "
+                        "(default: %(default)s)")
+    parser.add_argument("--images", type=int, default=10,
+                        help="number of distinct images "
+                        "(default: %(default)s)")
+    return parser.parse_args(args)
+
+class Generator(object):
+    """Synthesizes conversations and writes them with a format module"""
+    def __init__(self, module, options):
+        self.module = module
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.scratch = tempfile.mkdtemp(prefix=PROG)
+        # conversations are created in scratch, next to their images
+        self.path = join(self.scratch, 'source')
+        open(self.path, 'w').close()
+        self.images = []
+        for i in range(options.images):
+            self._write_image(i)
+        self.nconversations = 0
+        self.nentries = 0
+
+    def _write_image(self, i):
+        size = (self.random.randint(16, 640), self.random.randint(16, 480))
+        color = tuple(self.random.randint(0, 255) for x in range(3))
+        filename = IMAGE_FILENAME % i
+        Image.new('RGB', size, color).save(join(self.scratch, filename))
+        self.images.append(filename)
+
+    def cleanup(self):
+        shutil.rmtree(self.scratch)
+
+    def run(self):
+        # services every format can write, so the corpus can be
+        # converted to any of them
+        services = set(NAMES)
+        for module in formats.all_formats.values():
+            services &= set(module().PAM_ECIVRES)
+        services = sorted(services)
+        for i in range(self.options.accounts):
+            service = services[i % len(services)]
+            source = NAMES[service][0] % i
+            for j in range(self.options.contacts):
+                self._write_contact(service, source, j)
+
+    def _write_contact(self, service, source, j):
+        r = self.random
+        tzname, offset = r.choice(TIMEZONES)
+        tzinfo = getoffset(tzname, offset)
+        t = START.replace(tzinfo=tzinfo) + \
+            datetime.timedelta(seconds=r.randint(0, 86400 * 30))
+        for k in range(self.options.conversations):
+            isgroup = r.random() < self.options.group_ratio
+            if isgroup:
+                destination = GROUP_NAMES[service] % (j * 1000 + k)
+            else:
+                destination = NAMES[service][1] % j
+            conversation = Conversation(self.module, self.path, source,
+                                        destination, service, t, [], [],
+                                        isgroup=isgroup)
+            conversation.original_parser_name = self.module.type
+            end = self._fill(conversation)
+            self._write(conversation)
+            # next conversation starts hours to days later
+            t = end + datetime.timedelta(seconds=r.randint(3600, 86400 * 7))
+
+    def _get_participants(self, conversation):
+        """Return list of (sender, alias) of people in conversation,
+        starting with the user"""
+        r = self.random
+        aliases = r.sample(ALIASES, 6)
+        participants = [(conversation.source, aliases[0])]
+        if conversation.isgroup:
+            for i in range(r.randint(2, 5)):
+                participants.append((NAMES[conversation.service][1] %
+                                     r.randint(0, 10000), aliases[i+1]))
+        else:
+            participants.append((conversation.destination, aliases[1]))
+        return participants
+
+    def _fill(self, conversation):
+        """Add entries to conversation and return time of the last"""
+        r = self.random
+        options = self.options
+        participants = self._get_participants(conversation)
+        events = bool(self.module.EVENT_TYPEMAP)
+        statuses = [x for x in Status.USER_TYPES
+                    if x in self.module.PAMEPYT_SUTATS]
+
+        n = max(1, int(round(options.entries *
+                             math.exp(r.gauss(0, options.entries_sigma)))))
+        t = conversation.time
+        images = set()
+        entries = []
+        for i in range(n):
+            t += datetime.timedelta(seconds=int(r.expovariate(1 / 30.0)))
+            sender, alias = r.choice(participants)
+            kwargs = dict(sender=sender, alias=alias, time=t)
+            x = r.random()
+            if events and x < options.event_ratio:
+                entry = Event(type=r.choice((Event.WINDOWOPENED,
+                                             Event.WINDOWCLOSED)),
+                              sender=conversation.source, time=t)
+            elif statuses and x < options.event_ratio + options.status_ratio:
+                entry = self._get_status(r.choice(statuses), kwargs)
+            else:
+                if r.random() < options.image_ratio and self.images:
+                    image = r.choice(self.images)
+                    images.add(image)
+                    html = '<div><img src="%s"/></div>' % image
+                else:
+                    html = '<div>%s</div>' % ' '.join(
+                        r.choice(WORDS) for x in range(r.randint(1, 20)))
+                entry = Message(isuser=sender == conversation.source,
+                                raw_html=html, raw_xml=True,
+                                delayed=r.random() < options.delayed_ratio,
+                                **kwargs)
+            entries.append(entry)
+
+        conversation.images = sorted(images)
+        conversation.entries = entries
+        self.nentries += len(entries)
+        return t
+
+    def _get_status(self, statustype, kwargs):
+        # pidgin-html keeps status changes as text, which is matched
+        # against the strings pidgin writes
+        text = self.module.PAMEPYT_SUTATS[statustype]
+        if '{alias}' in text:
+            kwargs['text'] = text.format(alias=kwargs['alias'], type='away')
+        elif statustype == Status.AWAY and self.random.random() < 0.5:
+            kwargs['raw_msg_html'] = '<div>%s</div>' % ' '.join(
+                self.random.sample(WORDS, 3))
+            kwargs['raw_xml'] = True
+        return Status(type=statustype, **kwargs)
+
+    def _write(self, conversation):
+        path = join(self.options.destination,
+                    self.module.get_path(conversation))
+        if not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        self.module.write(path, [conversation])
+        self.nconversations += 1
+
+def generate(options):
+    """Write the corpus described by options and return its Generator"""
+    timezones.init()
+    # logs should look like they were written by the client itself
+    const.NO_COMMENTS = True
+    generator = Generator(formats.get(options.format)(), options)
+    try:
+        generator.run()
+    finally:
+        generator.cleanup()
+    return generator
+
+def gencorpus(options):
+    generator = generate(options)
+    print('%i conversations, %i entries written to %s' %
+          (generator.nconversations, generator.nentries, options.destination))
+    return 0
+
+if __name__ == "__main__":
+    options = parse_args()
+    exitcode = 0
+    try:
+        exitcode = gencorpus(options)
+    except KeyboardInterrupt:
+        exitcode = 1
+        print("***aborted***", file=sys.stderr)
+    except Exception as e:
+        exitcode = 1
+        traceback.print_exc()
+    finally:
+        sys.exit(exitcode)
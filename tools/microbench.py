@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+# Copyright 2013 Evan Vitero
+
+# This file is part of chatlogsync.
+
+# chatlogsync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# chatlogsync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with chatlogsync.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import math
+import codecs
+import timeit
+import shutil
+import datetime
+import tempfile
+import traceback
+from os.path import join, dirname
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from lxml import etree
+from bs4.element import NavigableString
+
+import chatlogsync
+from chatlogsync import timezones, util
+from chatlogsync.timezones import getoffset
+# the formats package has to be loaded before conversation
+from chatlogsync.formats.adium import Adium
+from chatlogsync.formats.pidgin import PidginHtml
+from chatlogsync.conversation import Conversation, Message, Status
+
+PROG = 'microbench'
+DESCRIPTION = 'Time hot functions of chatlogsync in-process'
+
+BENCHMARKS = OrderedDict()
+# entries in conversations written by the write benchmarks
+WRITE_ENTRIES = 100000
+# inputs handled by each call of the other benchmarks
+NOPS = 1000
+TMPDIR = tempfile.mkdtemp(prefix=PROG)
+
+def benchmark(setup):
+    """Register setup, which returns (function, number of operations
+    per call)"""
+    BENCHMARKS[setup.__name__] = setup
+    return setup
+
+def get_times(n):
+    start = datetime.datetime(2013, 8, 29, 14, 23, 1)
+    return [(start + datetime.timedelta(seconds=i * 37)).strftime(
+        '%Y-%m-%dT%H:%M:%S') + ('-07:00' if i % 2 else '-08:00')
+            for i in range(n)]
+
+@benchmark
+def adium_parse_time():
+    adium = Adium()
+    fmt = adium.STRPTIME_FMT_CONVERSATION
+    times = get_times(1000)
+    def run():
+        for t in times:
+            adium._parse_time(t, fmt)
+    return run, len(times)
+
+def get_conversation(module, n, destination='destination', start=None):
+    """Return a Conversation parsed by module with n entries"""
+    path = join(TMPDIR, 'source')
+    open(path, 'w').close()
+    tzinfo = getoffset('PDT', -25200)
+    if not start:
+        start = datetime.datetime(2013, 8, 29, 14, 23, 1, tzinfo=tzinfo)
+    conversation = Conversation(module, path, 'source', destination,
+                                'aim', start, [], [])
+    for i in range(n):
+        t = start + datetime.timedelta(seconds=i)
+        if i % 50 == 49:
+            entry = Status(sender='destination', time=t, type=Status.AWAY)
+        else:
+            sender = ('source', 'destination')[i % 2]
+            entry = Message(sender=sender, time=t, isuser=i % 2 == 0,
+                            text='message %i with <markup> & more text' % i)
+        conversation.entries.append(entry)
+
+    return conversation
+
+def get_conversations(module, n):
+    """Return n Conversations without entries with different
+    destinations and times"""
+    tzinfo = getoffset('PDT', -25200)
+    start = datetime.datetime(2013, 8, 29, 14, 23, 1, tzinfo=tzinfo)
+    return [get_conversation(module, 0, 'destination%i' % i,
+                             start + datetime.timedelta(minutes=i * 37))
+            for i in range(n)]
+
+def get_pidgin_lines(module, n):
+    """Return the entry lines of a pidgin log with n entries"""
+    conversation = get_conversation(module, n)
+    conversation.original_parser_name = module.type
+    path = join(TMPDIR, 'pidgin')
+    module.write(path, [conversation])
+    with codecs.open(path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    # skip the title and closing lines
+    return conversation, [x for x in lines if x.endswith('<br/>')]
+
+@benchmark
+def parse_string():
+    adium = Adium()
+    paths = [adium.get_path(c) for c in get_conversations(adium, NOPS)]
+    def run():
+        for path in paths:
+            util.parse_string(path, adium.FILE_PATTERN, path=True)
+    return run, len(paths)
+
+@benchmark
+def fill_pattern():
+    adium = Adium()
+    conversations = get_conversations(adium, NOPS)
+    def run():
+        for c in conversations:
+            adium.fill_pattern(c, adium.FILE_PATTERN, adium.TIME_FMT_FILE,
+                               untransform=True)
+    return run, len(conversations)
+
+@benchmark
+def adium_parse_entry():
+    adium = Adium()
+    conversation = get_conversation(adium, NOPS)
+    path = join(TMPDIR, 'adium')
+    adium.write(path, [conversation])
+    elems = [x for x in etree.parse(path).getroot()
+             if x.tag is not etree.Comment]
+    def run():
+        for elem in elems:
+            adium._parse_entry(elem, None, conversation, 'source', 'source')
+    return run, len(elems)
+
+@benchmark
+def pidgin_parse_line():
+    pidgin = PidginHtml()
+    conversation, lines = get_pidgin_lines(pidgin, NOPS)
+    base_time = conversation.time
+    def run():
+        for line in lines:
+            pidgin._parse_line(line, conversation, base_time)
+    return run, len(lines)
+
+@benchmark
+def pidgin_parse_status():
+    pidgin = PidginHtml()
+    conversation = get_conversation(pidgin, 0)
+    strings = [k.format(alias='Dest', type='away') for k in
+               pidgin.STATUS_TYPEMAP]
+    infos = [dict(html=[NavigableString(strings[i % len(strings)])],
+                  type=None, sender=None, alias=None)
+             for i in range(NOPS)]
+    def run():
+        for info in infos:
+            pidgin._parse_status(None, dict(info), conversation)
+    return run, len(infos)
+
+@benchmark
+def adium_write_xml():
+    adium = Adium()
+    conversation = get_conversation(adium, NOPS)
+    entries = conversation.entries
+    path = join(TMPDIR, 'output')
+    def run():
+        f = util.ChunkedWriter(path)
+        for entry in entries:
+            adium._write_xml(f, 'message', {'sender': entry.sender},
+                             conversation, contents=entry.html)
+        f.close()
+    return run, len(entries)
+
+@benchmark
+def pidgin_write_entry():
+    pidgin = PidginHtml()
+    conversation = get_conversation(pidgin, NOPS)
+    conversation.original_parser_name = pidgin.type
+    entries = conversation.entries
+    timefmt = pidgin.TIME_FMT_CONVERSATION
+    path = join(TMPDIR, 'output')
+    def run():
+        f = util.ChunkedWriter(path)
+        for entry in entries:
+            pidgin._write_entry(f, entry, conversation, timefmt)
+        f.close()
+    return run, len(entries)
+
+@benchmark
+def entry_init():
+    tzinfo = getoffset('PDT', -25200)
+    t = datetime.datetime(2013, 8, 29, 14, 23, 1, tzinfo=tzinfo)
+    def run():
+        for i in range(NOPS):
+            Message(sender='destination', alias='Dest', time=t,
+                    raw_html='<div>message</div>', raw_xml=True,
+                    validate=False)
+    return run, NOPS
+
+def write_benchmark(module):
+    conversation = get_conversation(module, WRITE_ENTRIES)
+    path = join(TMPDIR, 'output')
+    def run():
+        module.write(path, [conversation])
+    return run, WRITE_ENTRIES
+
+@benchmark
+def adium_write():
+    return write_benchmark(Adium())
+
+@benchmark
+def pidgin_write():
+    return write_benchmark(PidginHtml())
+
+def parse_args():
+    parser = ArgumentParser(prog=PROG, description=DESCRIPTION)
+    parser.add_argument("names", metavar="NAME", nargs='*',
+                        help="benchmarks to run (default: all of %s)" %
+                        ', '.join(BENCHMARKS))
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="number of timed runs of each benchmark")
+    parser.add_argument("-w", "--warmup", type=int, default=1,
+                        help="number of untimed runs before timing")
+    return parser.parse_args()
+
+def get_stats(rates):
+    """Return mean and relative standard deviation of rates"""
+    mean = sum(rates) / len(rates)
+    variance = sum((x - mean) ** 2 for x in rates) / len(rates)
+    return mean, math.sqrt(variance) / mean * 100
+
+def microbench(options):
+    timezones.init()
+    names = options.names or BENCHMARKS
+    unknown = [x for x in names if x not in BENCHMARKS]
+    if unknown:
+        print('unknown benchmarks: %s' % ', '.join(unknown), file=sys.stderr)
+        return 1
+
+    print('%-24s %12s %12s %8s' % ('benchmark', 'best ops/s', 'mean ops/s',
+                                   'stdev'))
+    for name in names:
+        function, nops = BENCHMARKS[name]()
+        for i in range(options.warmup):
+            function()
+        results = timeit.Timer(function).repeat(options.repeat, 1)
+        rates = [nops / x for x in results]
+        mean, stdev = get_stats(rates)
+        print('%-24s %12.0f %12.0f %7.1f%%' %
+              (name, max(rates), mean, stdev))
+    return 0
+
+if __name__ == "__main__":
+    options = parse_args()
+    exitcode = 0
+    try:
+        exitcode = microbench(options)
+    except KeyboardInterrupt:
+        exitcode = 1
+        print("***aborted***", file=sys.stderr)
+    except Exception as e:
+        exitcode = 1
+        traceback.print_exc()
+    finally:
+        shutil.rmtree(TMPDIR)
+        sys.exit(exitcode)